@@ -0,0 +1,158 @@
+'''
+Course search engine: compressed bitmaps of course ids
+
+A Bitmap splits its values by their high 16 bits into containers, as in
+Roaring bitmaps: a sparse container (at most ARRAY_MAX values) is a
+frozenset of the low 16 bits, a dense one is a Python int with one bit
+per low value.  Intersections work container by container, and only on
+the high parts both bitmaps have.
+'''
+
+# Largest number of values of a sparse container
+ARRAY_MAX = 4096
+
+
+def _bit_values(bits):
+    '''
+    Yield the positions of the set bits of an int, in increasing order.
+    '''
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def _to_bits(values):
+    bits = 0
+    for value in values:
+        bits |= 1 << value
+    return bits
+
+
+def _container(values, bits=None):
+    '''
+    Return the container of a set of low values (or of the int bits),
+    sparse or dense by its size.
+    '''
+    if bits is None:
+        return frozenset(values) if len(values) <= ARRAY_MAX else _to_bits(values)
+    if bin(bits).count("1") <= ARRAY_MAX:
+        return frozenset(_bit_values(bits))
+    return bits
+
+
+def _intersect(container1, container2):
+    if isinstance(container1, int) and isinstance(container2, int):
+        return _container(None, container1 & container2)
+    if isinstance(container1, int):
+        container1, container2 = container2, container1
+    if isinstance(container2, int):
+        return frozenset(value for value in container1 if container2 >> value & 1)
+    return container1 & container2
+
+
+def _size(container):
+    if isinstance(container, int):
+        return bin(container).count("1")
+    return len(container)
+
+
+class Bitmap:
+    '''
+    Compressed set of non-negative integers (see the module docstring).
+    '''
+
+    def __init__(self, values=()):
+        by_high = {}
+        for value in values:
+            by_high.setdefault(value >> 16, set()).add(value & 0xffff)
+        self.containers = {high: _container(lows) for high, lows in by_high.items()}
+
+    @classmethod
+    def _from_containers(cls, containers):
+        bitmap = cls()
+        bitmap.containers = containers
+        return bitmap
+
+    def __and__(self, other):
+        containers = {}
+        for high, container in self.containers.items():
+            other_container = other.containers.get(high)
+            if other_container is not None:
+                both = _intersect(container, other_container)
+                if both:
+                    containers[high] = both
+        return Bitmap._from_containers(containers)
+
+    def __len__(self):
+        return sum(_size(container) for container in self.containers.values())
+
+    def __bool__(self):
+        return bool(self.containers)
+
+    def __contains__(self, value):
+        container = self.containers.get(value >> 16)
+        if container is None:
+            return False
+        if isinstance(container, int):
+            return bool(container >> (value & 0xffff) & 1)
+        return value & 0xffff in container
+
+    def __iter__(self):
+        '''
+        Iterate over the values, in increasing order.
+        '''
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            lows = _bit_values(container) if isinstance(container, int) else sorted(container)
+            for low in lows:
+                yield high << 16 | low
+
+
+def intersect(bitmaps):
+    '''
+    Intersect a list of bitmaps, smallest first, stopping as soon as the
+    intersection is empty.
+    '''
+    if not bitmaps:
+        return Bitmap()
+    bitmaps = sorted(bitmaps, key=len)
+    result = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        if not result:
+            break
+        result = result & bitmap
+    return result
+
+
+class TermIndex:
+    '''
+    Bitmap of the course ids of every word of catalog_index.
+    '''
+
+    def __init__(self, rows):
+        '''
+        Inputs:
+            rows: (word, course_id) rows
+        '''
+        course_ids = {}
+        all_ids = set()
+        for word, course_id in rows:
+            course_ids.setdefault(word, []).append(course_id)
+            all_ids.add(course_id)
+        self.bitmaps = {word: Bitmap(ids) for word, ids in course_ids.items()}
+        # Number of courses with any word
+        self.num_courses = len(all_ids)
+
+    def courses_with_all(self, words):
+        '''
+        Return the sorted list of the ids of the courses with every one of
+        words.
+        '''
+        bitmaps = []
+        for word in set(words):
+            bitmap = self.bitmaps.get(word)
+            if bitmap is None:
+                return []
+            bitmaps.append(bitmap)
+        return list(intersect(bitmaps))
@@ -4,24 +4,254 @@ Course search engine: search
 Vera Mao, Yixin Ding
 '''
 
-from math import radians, cos, sin, asin, sqrt, ceil
+from math import radians, cos, sin, asin, sqrt, ceil, log
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import hashlib
+import heapq
+import functools
 import sqlite3
+import threading
+import time
+import urllib.request
+import weakref
+import json
 import os
+import re
+
+from bitmap import TermIndex
 
 
 # Use this filename for the database
 DATA_DIR = os.path.dirname(__file__)
 DATABASE_FILENAME = os.path.join(DATA_DIR, 'course_information.sqlite3')
 
-conn = sqlite3.connect(DATABASE_FILENAME)
-cur = conn.cursor()
+# Settings of the read-only connections
+CONNECTION_PRAGMAS = ["PRAGMA query_only = ON",
+                      "PRAGMA cache_size = -16384",
+                      "PRAGMA temp_store = MEMORY"]
+
+_local = threading.local()
+# Holders of the open connections; a holder goes away with its thread
+_holders = weakref.WeakSet()
+_holders_lock = threading.Lock()
+# Incremented by close_connections, to retire every thread's connection
+_generation = [0]
+
+class _ConnectionHolder:
+    """
+    A thread's connection, kept in the thread's local storage.  The
+    connection is closed when the holder is collected, which happens when
+    the thread exits, or earlier by close_connections.
+    """
+
+    def __init__(self, conn, filename, generation):
+        self.conn = conn
+        self.filename = filename
+        self.generation = generation
+        self.close = weakref.finalize(self, conn.close)
+
+def open_connection():
+    """
+    Open a new read-only connection to DATABASE_FILENAME (see
+    get_connection), owned by the caller.
+    """
+    uri = "file:{}?mode=ro".format(
+        urllib.request.pathname2url(os.path.abspath(DATABASE_FILENAME)))
+    # close_connections and the holder's finalizer may close it from
+    # another thread
+    conn = sqlite3.connect(uri, uri=True, isolation_level=None,
+                           check_same_thread=False)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    conn.create_function("time_between", 4, compute_time_between)
+    conn.create_aggregate("phrase_match", 4, PhraseMatch)
+    return conn
+
+def get_connection():
+    """
+    Return the calling thread's connection to DATABASE_FILENAME, opening
+    it on first use, and closing it when the thread exits.
+
+    Every thread gets its own read-only connection (URI mode=ro), so
+    concurrent searches neither share a cursor nor wait on each other.
+    The connections run in autocommit mode: each query reads a snapshot
+    and holds no transaction afterwards.  With the database's rollback
+    journal, a writer (such as the crawler's loader) still waits for the
+    queries that are reading, but never for an idle connection.
+    """
+    holder = getattr(_local, "holder", None)
+    if (holder is not None and holder.filename == DATABASE_FILENAME
+            and holder.generation == _generation[0]):
+        return holder.conn
+    if holder is not None:
+        holder.close()
+    conn = open_connection()
+    with _holders_lock:
+        holder = _ConnectionHolder(conn, DATABASE_FILENAME, _generation[0])
+        _holders.add(holder)
+    _local.holder = holder
+    return conn
+
+def close_connections():
+    """
+    Close the connections opened by every thread.  A thread that
+    searches again afterwards opens a new one.
+    """
+    with _holders_lock:
+        holders = list(_holders)
+        _generation[0] += 1
+    for holder in holders:
+        holder.close()
+
+# Words as tokenized by the crawler's analyzer
+WORD_RE = re.compile(r'\b([a-zA-Z][\w\-]*)\b')
+# A term with several words is a phrase; "words~k" allows up to k other
+# words between consecutive words of the phrase
+PHRASE_RE = re.compile(r'^(.*?)(?:~(\d+))?$', re.DOTALL)
+# Number of courses returned by a ranked search
+TOP_K = 20
+
+# Number of searches, and seconds, the results of a search are kept
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 300
+
+# Rows read at a time by stream_courses, and rows of a page of
+# find_courses_page
+STREAM_BATCH_SIZE = 100
+PAGE_SIZE = 25
+
+# Number of threads of the executor of find_courses_async
+ASYNC_WORKERS = 4
+_executor = [None]
+_executor_lock = threading.Lock()
+
+# Tables find_courses joins, and the order in which it joins them
+JOIN_TABLES = ["courses", "sections", "meeting_patterns", "catalog_index", "gps"]
+# Order of the search criteria in the generated SQL
+KEY_ORDER = ["terms", "dept", "day", "enrollment", "time_start", "time_end",
+             "building_code", "walking_time"]
+
+class SchemaCatalog:
+    """
+    Columns of every table of the database, and the join graph between
+    JOIN_TABLES: two tables are joined on their common column, if they
+    have exactly one.  Loaded once per database (see get_catalog).
+    """
+
+    def __init__(self, conn):
+        tables = [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.columns = {table: [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+                        for table in tables}
+        self.join_graph = {}
+        for i, table1 in enumerate(JOIN_TABLES):
+            for table2 in JOIN_TABLES[i + 1:]:
+                common = (set(self.columns.get(table1, []))
+                          & set(self.columns.get(table2, [])))
+                if len(common) == 1:
+                    self.join_graph[(table1, table2)] = self.join_graph[(table2, table1)] = \
+                        common.pop()
+        self.stop_words = frozenset()
+        if self.has_table("catalog_stop_words"):
+            self.stop_words = frozenset(word for (word,) in conn.execute(
+                "SELECT word FROM catalog_stop_words"))
+
+    def has_table(self, table):
+        """
+        Does the database have table?
+        """
+        return table in self.columns
+
+    def common_column(self, table1, table2):
+        """
+        Return the column table1 and table2 are joined on, or None.
+        """
+        return self.join_graph.get((table1, table2))
+
+    def join_conditions(self, tables):
+        """
+        Return the conditions that join each of tables to the first of the
+        tables before it that it has a common column with.
+        """
+        conditions = []
+        for i, table in enumerate(tables[1:], 1):
+            for earlier in tables[:i]:
+                column = self.common_column(earlier, table)
+                if column:
+                    conditions.append(f"{earlier}.{column} = {table}.{column}")
+                    break
+        return conditions
+
+@functools.lru_cache(maxsize=None)
+def _load_catalog(filename):
+    return SchemaCatalog(get_connection())
+
+_schema_versions = {}  # database filename -> PRAGMA schema_version of its catalog
+_schema_versions_lock = threading.Lock()
+
+def get_catalog():
+    """
+    Return the SchemaCatalog of DATABASE_FILENAME, loading it on first use,
+    and again, with the query plans, whenever the PRAGMA schema_version
+    of the database changed: another connection created, dropped or
+    replaced a table or an index.
+    """
+    (schema_version,) = get_connection().execute("PRAGMA schema_version").fetchone()
+    with _schema_versions_lock:
+        last = _schema_versions.get(DATABASE_FILENAME)
+        _schema_versions[DATABASE_FILENAME] = schema_version
+    if last is not None and last != schema_version:
+        clear_plans()
+    return _load_catalog(DATABASE_FILENAME)
+
+def clear_plans():
+    """
+    Forget the schema catalogs and the query plans, after the schema of
+    the database changed.
+    """
+    _load_catalog.cache_clear()
+    plan_query.cache_clear()
+
+_term_indexes = {}  # database filename -> (database_stamp(), TermIndex)
+_term_indexes_lock = threading.Lock()
+
+def database_stamp():
+    """
+    Return the modification times and sizes of DATABASE_FILENAME and of
+    its write-ahead log, which change with every write to the database.
+    """
+    stamp = []
+    for filename in [DATABASE_FILENAME, DATABASE_FILENAME + "-wal"]:
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        stamp.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(stamp)
+
+def get_term_index():
+    """
+    Return the TermIndex (bitmaps of course ids by word) of the
+    catalog_index table of DATABASE_FILENAME, loading it again if the
+    database changed since it was loaded.
+    """
+    stamp = database_stamp()
+    with _term_indexes_lock:
+        loaded = _term_indexes.get(DATABASE_FILENAME)
+        if loaded is None or loaded[0] != stamp:
+            rows = get_connection().execute("SELECT word, course_id FROM catalog_index")
+            loaded = _term_indexes[DATABASE_FILENAME] = (stamp, TermIndex(rows))
+        return loaded[1]
 
 def list_of_variable(table):
     """
     Retrieve a list of column names for a given database table.
     """
-    query = f"PRAGMA table_info({table})"
-    return [row[1] for row in cur.execute(query).fetchall()]
+    return list(get_catalog().columns.get(table, []))
 
 def find_common_variable(table1, table2):
     """
@@ -32,13 +262,291 @@ def find_common_variable(table1, table2):
     common_columns = columns_table1.intersection(columns_table2)
     return common_columns.pop() if len(common_columns) == 1 else None
 
-def find_courses(args_from_ui):
+def decode_positions(data):
     """
-    Finds courses matching the specified search criteria.
+    Decode the delta-encoded varint positions of a catalog_positions row.
     """
-    if not args_from_ui:
-        return ([], [])
-    
+    positions = []
+    prev = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        prev += value
+        positions.append(prev)
+        value = 0
+        shift = 0
+    return positions
+
+def parse_phrase(term, stop_words):
+    """
+    Parse a term of the terms argument into a phrase.
+
+    Returns:
+        (list of [word, offset] pairs, slop) for a term with more than one
+        word, where offset is the position of the word in the phrase
+        (stop words are skipped but keep their place), or None
+    """
+    text, slop = PHRASE_RE.match(term).groups()
+    words = WORD_RE.findall(text.lower())
+    if len(words) < 2:
+        return None
+    phrase = [[word, offset] for offset, word in enumerate(words)
+              if word not in stop_words]
+    return phrase, int(slop or 0)
+
+def phrase_matches(phrase, slop, word_positions):
+    """
+    Do the words of phrase occur in order, each at its offset from the
+    previous one plus at most slop other words?
+
+    Inputs:
+        phrase: list of [word, offset] pairs
+        slop: number of extra words allowed between consecutive words
+        word_positions: dict of word -> sorted positions in the course text
+    """
+    reached = word_positions.get(phrase[0][0], [])
+    prev_offset = phrase[0][1]
+    for word, offset in phrase[1:]:
+        distance = offset - prev_offset
+        prev_offset = offset
+        positions = word_positions.get(word, [])
+        # positions of word that follow some reached position of the
+        # previous word at the right distance
+        reached = [p for p in positions
+                   if bisect_right(reached, p - distance)
+                   > bisect_left(reached, p - distance - slop)]
+        if not reached:
+            return False
+    return bool(reached)
+
+class PhraseMatch:
+    """
+    SQLite aggregate phrase_match(word, positions, phrase, slop): true if
+    the (word, positions) rows of a course contain phrase, a JSON list of
+    [word, offset] pairs (see phrase_matches).
+    """
+
+    def __init__(self):
+        self.word_positions = {}
+        self.phrase = None
+        self.slop = 0
+
+    def step(self, word, positions, phrase, slop):
+        self.word_positions[word] = decode_positions(positions)
+        self.phrase = phrase
+        self.slop = slop
+
+    def finalize(self):
+        if self.phrase is None:
+            return 0
+        return int(phrase_matches(json.loads(self.phrase), self.slop,
+                                  self.word_positions))
+
+def split_terms(terms, catalog=None):
+    """
+    Split the terms argument into the words that courses must contain
+    and the phrases they must contain.
+
+    Phrases are matched against the catalog_positions table written by
+    the crawler (crawler.py --db FILE --positions).  Without it, the
+    words of a phrase are only required to occur in the course.
+
+    Returns:
+        (words, phrases) pair, where phrases is a list of (phrase, slop)
+        pairs (see parse_phrase)
+    """
+    if catalog is None:
+        catalog = get_catalog()
+    has_positions = catalog.has_table("catalog_positions")
+    stop_words = catalog.stop_words if has_positions else frozenset()
+    words = []
+    phrases = []
+    for term in terms:
+        parsed = parse_phrase(term, stop_words)
+        if parsed is None:
+            words.append(term)
+        elif not parsed[0]:
+            # Only stop words, which the index leaves out: the term stays
+            # a word no course has, so that it matches nothing
+            words.append(term)
+        elif has_positions:
+            phrases.append(parsed)
+        else:
+            words.extend(word for word, _ in parsed[0] if word not in words)
+    return words, phrases
+
+def max_score_top_k(postings, k, allowed=None):
+    """
+    Find the k courses with the highest sum of scores over postings lists,
+    with MaxScore dynamic pruning.
+
+    The lists are ordered by their upper bound.  Once k courses have been
+    scored, the lists whose upper bounds add up to less than the k-th best
+    score cannot bring a course into the top k on their own: only courses
+    in the other ("essential") lists are visited, and a course is dropped
+    as soon as its score plus the upper bounds of the lists still to check
+    falls below the k-th best score.
+
+    Inputs:
+        postings: list of (upper_bound, course_ids, scores) triples, with
+          course_ids sorted and upper_bound >= every score of the list
+        k: number of courses to return
+        allowed: optional set of the course ids that may be returned
+
+    Returns:
+        list of (course_id, score) pairs, by decreasing score and then
+        increasing course id (empty if k <= 0)
+    """
+    if k <= 0:
+        return []
+    lists = sorted((p for p in postings if p[1]), key=lambda p: p[0])
+    bounds = []
+    total = 0.0
+    for upper_bound, _, _ in lists:
+        total += upper_bound
+        bounds.append(total)
+    pointers = [0] * len(lists)
+    top = []  # min-heap of (score, -course_id): the worst course first
+    threshold = float("-inf")
+    first_essential = 0
+
+    while first_essential < len(lists):
+        course_id = min((lists[i][1][pointers[i]] for i in range(first_essential, len(lists))
+                         if pointers[i] < len(lists[i][1])), default=None)
+        if course_id is None:
+            break
+        score = 0.0
+        for i in range(first_essential, len(lists)):
+            course_ids = lists[i][1]
+            if pointers[i] < len(course_ids) and course_ids[pointers[i]] == course_id:
+                score += lists[i][2][pointers[i]]
+                pointers[i] += 1
+        if allowed is not None and course_id not in allowed:
+            continue
+
+        for i in range(first_essential - 1, -1, -1):
+            if score + bounds[i] < threshold:
+                break
+            course_ids = lists[i][1]
+            pointers[i] = bisect_left(course_ids, course_id, pointers[i])
+            if pointers[i] < len(course_ids) and course_ids[pointers[i]] == course_id:
+                score += lists[i][2][pointers[i]]
+        else:
+            entry = (score, -course_id)
+            if len(top) < k:
+                heapq.heappush(top, entry)
+            elif entry > top[0]:
+                heapq.heapreplace(top, entry)
+            else:
+                continue
+            if len(top) == k:
+                threshold = top[0][0]
+                while first_essential < len(lists) and bounds[first_essential] < threshold:
+                    first_essential += 1
+
+    return [(-neg_course_id, score) for score, neg_course_id in sorted(top, reverse=True)]
+
+def rank_courses(words, k=TOP_K, allowed=None):
+    """
+    Rank the courses with any of words by BM25 and return the top k.
+
+    The scores are the ones precomputed by the crawler in catalog_scores
+    and catalog_term_stats (crawler.py --db FILE --positions).  Without
+    them, the scores are computed from catalog_index alone, as the
+    inverse document frequency of the words a course contains, with the
+    counts of the cached term index (see get_term_index).
+
+    Returns:
+        list of (course_id, score) pairs (see max_score_top_k)
+    """
+    cur = get_connection().cursor()
+    postings = []
+    if get_catalog().has_table("catalog_term_stats"):
+        for word in dict.fromkeys(words):
+            row = cur.execute("SELECT max_score FROM catalog_term_stats WHERE word = ?",
+                              (word,)).fetchone()
+            if row is None:
+                continue
+            rows = cur.execute("SELECT course_id, score FROM catalog_scores "
+                               "WHERE word = ? ORDER BY course_id", (word,)).fetchall()
+            postings.append((row[0], [r[0] for r in rows], [r[1] for r in rows]))
+    else:
+        term_index = get_term_index()
+        num_courses = term_index.num_courses
+        for word in dict.fromkeys(words):
+            course_ids = list(term_index.bitmaps.get(word, ()))
+            df = len(course_ids)
+            idf = log(1 + (num_courses - df + 0.5) / (df + 0.5))
+            postings.append((idf, course_ids, [idf] * df))
+    return max_score_top_k(postings, k, allowed)
+
+QueryPlan = namedtuple("QueryPlan", ["sql", "allowed_sql", "num_keys"], defaults=[0])
+
+def gps_hash(conn):
+    """
+    Return a hash of the rows of the gps table of the database on conn,
+    which the walking_times table records to tell whether it is stale.
+    """
+    digest = hashlib.sha1()
+    for row in conn.execute("SELECT building_code, lon, lat FROM gps "
+                            "ORDER BY building_code, lon, lat"):
+        digest.update(json.dumps(row).encode())
+    return digest.hexdigest()
+
+_gps_hashes = {}  # database filename -> (database_stamp(), gps_hash)
+_gps_hashes_lock = threading.Lock()
+
+def use_walking_times(args_from_ui):
+    """
+    Can the walking times of the search be looked up in the walking_times
+    table (see walking_times.py)?  Only if the table was computed from the
+    current rows of gps (the triggers on gps only see changes to the
+    table, not a new table) and has the times up to
+    args_from_ui["walking_time"].
+    """
+    if "walking_time" not in args_from_ui:
+        return False
+    catalog = get_catalog()
+    if "gps_hash" not in catalog.columns.get("walking_times_meta", []):
+        return False
+    conn = get_connection()
+    row = conn.execute("SELECT max_time, gps_hash FROM walking_times_meta").fetchone()
+    if row is None or args_from_ui["walking_time"] > row[0]:
+        return False
+    stamp = database_stamp()
+    with _gps_hashes_lock:
+        known = _gps_hashes.get(DATABASE_FILENAME)
+        if known is None or known[0] != stamp:
+            known = _gps_hashes[DATABASE_FILENAME] = (stamp, gps_hash(conn))
+    return row[1] == known[1]
+
+@functools.lru_cache(maxsize=None)
+def plan_query(filename, keys, has_words, num_phrases, ranked, walking_table=False,
+               paged=False, after=False):
+    """
+    Generate the SQL of a query shape: the set of keys of args_from_ui,
+    whether the terms have words, whose courses are looked up in the
+    term index (see get_term_index), and how many phrases they have (see
+    split_terms), whether it is ranked, and whether the walking times
+    come from the walking_times table (see use_walking_times) instead of
+    being computed.  Every query of a shape only differs in the values
+    bound to the parameters (see bind_values).
+
+    A paged (unranked) query also selects the sort key of its rows,
+    orders them by it and takes a LIMIT; after a page, it only takes the
+    rows whose key is greater than the last key of the page (see
+    find_courses_page).
+
+    Returns:
+        QueryPlan with the SQL of the query, for a ranked query with
+        other criteria the SQL of the course ids that meet them, and the
+        number of sort key columns after the columns of the results
+    """
+    catalog = _load_catalog(filename)
     column_map = {
         "terms": "catalog_index.word",
         "dept": "courses.dept",
@@ -52,74 +560,487 @@ def find_courses(args_from_ui):
         "building_code": "b.building_code",
         "walking_time": "walking_time"
     }
-    
+
     base_columns = ["dept", "course_num", "title"]
     section_columns = ["section_num", "day", "time_start", "time_end", "enrollment"]
     location_columns = ["building_code", "walking_time"]
     selected_columns = base_columns[:]
-    
-    joins = ["courses"]
-    if "building_code" in args_from_ui:
+
+    tables = ["courses"]
+    if "building_code" in keys:
         selected_columns.extend(section_columns + location_columns)
-        joins.extend(["sections", "meeting_patterns"])
-    elif any(k in args_from_ui for k in ["day", "enrollment", "time_start", "time_end"]):
+        tables.extend(["sections", "meeting_patterns"])
+    elif any(k in keys for k in ["day", "enrollment", "time_start", "time_end"]):
         selected_columns.extend(section_columns)
-        joins.extend(["sections", "meeting_patterns"])
-    
+        tables.extend(["sections", "meeting_patterns"])
     selected_columns = [column_map[col] for col in selected_columns]
-    conditions = []
-    join_conditions = []
-    
-    for i in range(len(joins) - 1):
-        common_col = find_common_variable(joins[i], joins[i + 1])
-        if common_col:
-            join_conditions.append(f"{joins[i]}.{common_col} = {joins[i + 1]}.{common_col}")
-    
-    if "terms" in args_from_ui:
-        joins.append("catalog_index")
-        join_conditions.append("courses.course_id = catalog_index.course_id")
-    
-    if "building_code" in args_from_ui:
-        conn.create_function("time_between", 4, compute_time_between)
+
+    join_conditions = catalog.join_conditions(tables)
+    joins = tables[:]
+
+    if "building_code" in keys and walking_table:
+        joins.append("walking_times AS w")
+        join_conditions.append("sections.building_code = w.other_code")
+        selected_columns[-2] = "sections.building_code"
+        selected_columns[-1] = "w.walking_time"
+        column_map["building_code"] = "w.building_code"
+        column_map["walking_time"] = "w.walking_time"
+    elif "building_code" in keys:
+        column = catalog.common_column("sections", "gps")
         joins.append("gps AS a JOIN (SELECT lon, lat, building_code FROM gps) AS b")
-        join_conditions.append("sections.building_code = a.building_code")
+        join_conditions.append(f"sections.{column} = a.{column}")
         selected_columns[-2] = "a.building_code"
         selected_columns[-1] = "time_between(a.lon, a.lat, b.lon, b.lat) AS walking_time"
-    
-    filter_conditions = []
-    filter_values = []
+
+    # Lists are bound as one JSON array parameter, so the SQL does not
+    # depend on their lengths
     where_clauses = {
-        "terms": f"IN ({', '.join(['?'] * len(args_from_ui['terms']))})" if "terms" in args_from_ui else "",
+        "terms": "courses.course_id IN (SELECT value FROM json_each(?))",
         "dept": "= ?",
-        "day": f"IN ({', '.join(['?'] * len(args_from_ui['day']))})" if "day" in args_from_ui else "",
+        "day": "IN (SELECT value FROM json_each(?))",
         "enrollment": "BETWEEN ? AND ?",
         "time_start": ">= ?",
         "time_end": "<= ?",
         "building_code": "= ?",
         "walking_time": "<= ?"
     }
-    
-    for key in args_from_ui:
+    filter_conditions = []
+    for key in sorted(keys, key=KEY_ORDER.index):
+        if key == "terms":
+            if has_words:
+                filter_conditions.append(where_clauses[key])
+            # Phrases are matched inside the positional index
+            filter_conditions.extend(
+                ["courses.course_id IN (SELECT course_id FROM catalog_positions "
+                 "WHERE word IN (SELECT value FROM json_each(?)) "
+                 "GROUP BY course_id HAVING phrase_match(word, positions, ?, ?))"]
+                * num_phrases)
+            continue
         filter_conditions.append(f"{column_map[key]} {where_clauses[key]}")
-        filter_values.extend(args_from_ui[key] if isinstance(args_from_ui[key], (list, tuple)) else [args_from_ui[key]])
-    
+
     group_clause = None
-    if "terms" in args_from_ui:
-        group_clause = f"GROUP BY catalog_index.course_id HAVING COUNT(DISTINCT word) = {len(args_from_ui['terms'])}"
+    if has_words:
+        group_clause = "GROUP BY courses.course_id"
+        if "sections" in joins:
+            group_clause = "GROUP BY courses.course_id, sections.section_num"
+
+    def from_clause():
+        return " ".join(filter(None, [
+            f"FROM {' JOIN '.join(joins)}",
+            f"ON {' AND '.join(join_conditions)}" if join_conditions else None]))
+
+    allowed_sql = None
+    order_clause = None
+    if ranked:
+        if filter_conditions:
+            allowed_sql = (f"SELECT DISTINCT courses.course_id {from_clause()} "
+                           f"WHERE {' AND '.join(filter_conditions)}")
+        # The scores are bound as one JSON object of course id -> score,
+        # before the values of the other criteria: no other join has
+        # parameters
+        joins.append("json_each(?) AS scores")
+        join_conditions.append("courses.course_id = scores.key")
+        selected_columns.append("scores.value AS score")
+        order_clause = "ORDER BY score DESC, courses.course_id"
+
+    # A course has one row per section, if sections are joined
+    key_columns = []
+    if paged:
+        key_columns = ["courses.course_id"]
         if "sections" in joins:
-            group_clause = f"GROUP BY catalog_index.course_id, sections.section_num HAVING COUNT(DISTINCT word) = {len(args_from_ui['terms'])}"
-    
-    query = " ".join(filter(None, [
+            key_columns = ["sections.course_id", "sections.section_id"]
+        selected_columns.extend(key_columns)
+        if after:
+            filter_conditions.append("({}) > ({})".format(
+                ", ".join(key_columns), ", ".join(["?"] * len(key_columns))))
+        order_clause = f"ORDER BY {', '.join(key_columns)} LIMIT ?"
+
+    sql = " ".join(filter(None, [
         f"SELECT {', '.join(selected_columns)}",
-        f"FROM {' JOIN '.join(joins)}",
-        f"ON {' AND '.join(join_conditions)}" if join_conditions else None,
+        from_clause(),
         "WHERE " + " AND ".join(filter_conditions) if filter_conditions else None,
-        group_clause
+        group_clause,
+        order_clause
     ]))
-    
-    results = cur.execute(query, filter_values).fetchall()
+    return QueryPlan(sql, allowed_sql, len(key_columns))
+
+def bind_values(args_from_ui, course_ids, phrases):
+    """
+    Return the values of the parameters of the query planned for
+    args_from_ui by plan_query, in order.  course_ids are the ids of the
+    courses with every word of the terms, or None if they have none.
+    """
+    values = []
+    for key in sorted(args_from_ui, key=KEY_ORDER.index):
+        value = args_from_ui[key]
+        if key == "terms":
+            if course_ids is not None:
+                values.append(json.dumps(course_ids))
+            for phrase, slop in phrases:
+                values.extend([json.dumps(sorted({word for word, _ in phrase})),
+                               json.dumps(phrase), slop])
+        elif key == "day":
+            values.append(json.dumps(list(value)))
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        else:
+            values.append(value)
+    return values
+
+def explain(args_from_ui):
+    """
+    Return the steps of the EXPLAIN QUERY PLAN of the (unranked) query
+    of find_courses(args_from_ui), as strings such as
+    "SEARCH courses USING INDEX courses_dept (dept=?)".
+    """
+    if not args_from_ui:
+        return []
+    plan, values, _ = plan_search(args_from_ui)
+    return [row[3] for row in
+            get_connection().execute("EXPLAIN QUERY PLAN " + plan.sql, values)]
+
+def normalize_args(args_from_ui, top_k=None):
+    """
+    Return the key of a search in the result cache: the same for every
+    order of the keys of args_from_ui and of its terms and days.
+    """
+    items = []
+    for key, value in args_from_ui.items():
+        if key in ("terms", "day"):
+            value = tuple(sorted(value))
+        elif isinstance(value, list):
+            value = tuple(value)
+        items.append((key, value))
+    return (DATABASE_FILENAME, top_k, tuple(sorted(items)))
+
+class ResultCache:
+    """
+    Results of the last maxsize searches, each kept at most ttl seconds.
+
+    The cache is emptied when the database changes: when the modification
+    time or size of its files changes (see database_stamp), or when the
+    PRAGMA data_version of the calling thread's connection changes, which
+    it does whenever another connection commits.
+
+    stats counts the hits, the misses, the evictions of the least
+    recently used results, the expired results and the invalidations.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (time stored, results)
+        self.stamp = None
+        # (connection, last PRAGMA data_version) of each thread
+        self.local = threading.local()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0,
+                      "invalidations": 0}
+        self.lock = threading.Lock()
+
+    def _check_version(self):
+        conn = get_connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        stamp = database_stamp()
+        last = getattr(self.local, "data_version", None)
+        changed = last is not None and last[0] is conn and last[1] != data_version
+        self.local.data_version = (conn, data_version)
+        if stamp != self.stamp or changed:
+            if self.entries:
+                self.stats["invalidations"] += 1
+            self.entries.clear()
+            self.stamp = stamp
+
+    def get(self, key):
+        """
+        Return the cached results of a search, or None.
+        """
+        with self.lock:
+            self._check_version()
+            entry = self.entries.get(key)
+            if entry is not None and self.clock() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, results):
+        """
+        Store the results of a search, evicting the least recently used
+        results if the cache is full.
+        """
+        with self.lock:
+            self.entries[key] = (self.clock(), results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        """
+        Empty the cache and reset its statistics.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.stamp = None
+            for name in self.stats:
+                self.stats[name] = 0
+
+result_cache = ResultCache()
+
+def find_courses(args_from_ui, top_k=None):
+    """
+    Finds courses matching the specified search criteria.
+
+    The results of recent searches are kept in result_cache, so a
+    repeated search does not query the database again (see search_courses
+    for the arguments).
+    """
+    key = normalize_args(args_from_ui, top_k)
+    results = result_cache.get(key)
+    if results is None:
+        results = search_courses(args_from_ui, top_k)
+        result_cache.put(key, results)
+    header, rows = results
+    # Callers get their own lists
+    return (list(header), list(rows))
+
+def plan_search(args_from_ui, top_k=None, paged=False, after=False):
+    """
+    Plan a search (see search_courses for the arguments, and plan_query
+    for paged and after).
+
+    Returns:
+        (plan, values, rank_words) triple: the QueryPlan of the search's
+        shape, the values to bind to it, and the words to rank the
+        courses by, or None if the search is not ranked
+    """
+    words, phrases = split_terms(args_from_ui.get("terms", []), get_catalog())
+    ranked = top_k is not None and "terms" in args_from_ui
+    rank_words = None
+    if ranked:
+        # Every word is scored, none is required
+        rank_words = words + [word for phrase, _ in phrases for word, _ in phrase]
+        words = []
+
+    # The courses with every word are the intersection of the words'
+    # bitmaps, which the query only has to join with the other criteria
+    course_ids = get_term_index().courses_with_all(words) if words else None
+    plan = plan_query(DATABASE_FILENAME, frozenset(args_from_ui), bool(words),
+                      len(phrases), ranked, use_walking_times(args_from_ui), paged, after)
+    return plan, bind_values(args_from_ui, course_ids, phrases), rank_words
+
+def execute_search(cur, plan, values, rank_words=None, top_k=None):
+    """
+    Execute the query of a search planned by plan_search on the cursor
+    cur, leaving its rows to be fetched.
+    """
+    if rank_words is not None:
+        allowed = None
+        if plan.allowed_sql:
+            allowed = {course_id for (course_id,) in cur.execute(plan.allowed_sql, values)}
+        scores = dict(rank_courses(rank_words, top_k, allowed))
+        values = [json.dumps(scores)] + values
+    return cur.execute(plan.sql, values)
+
+def run_search(cur, plan, values, rank_words=None, top_k=None):
+    """
+    Run a search planned by plan_search on the cursor cur.
+
+    Returns:
+        (header, rows) pair
+    """
+    results = execute_search(cur, plan, values, rank_words, top_k).fetchall()
     return (get_header(cur), results)
 
+def search_courses(args_from_ui, top_k=None):
+    """
+    Finds courses matching the specified search criteria, in the database.
+
+    The SQL of each query shape is generated once (see plan_query): a
+    search only binds its values to it.
+
+    If top_k is given and there are terms, the courses are ranked
+    instead: the courses with any of the words of the terms are scored
+    by BM25 (see rank_courses), and the rows of the top_k best courses
+    that meet the other criteria (including phrases) are returned, best
+    first, with their score in an extra last column.
+    """
+    if not args_from_ui:
+        return ([], [])
+    plan, values, rank_words = plan_search(args_from_ui, top_k)
+    return run_search(get_connection().cursor(), plan, values, rank_words, top_k)
+
+def stream_courses(args_from_ui, top_k=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    Finds courses like search_courses, but returns the rows as they are
+    read from the database, batch_size at a time, instead of a list.
+
+    The query runs on a connection of its own (see open_connection), so
+    it neither holds a statement open on the thread's connection nor is
+    closed by close_connections.  It keeps reading one snapshot of the
+    database until the rows run out or the generator is closed, which
+    closes the connection.  A ranked search has at most top_k rows, which
+    are read at once.
+
+    Returns:
+        (header, rows) pair, where rows is a generator
+    """
+    if not args_from_ui:
+        return ([], iter([]))
+    plan, values, rank_words = plan_search(args_from_ui, top_k)
+    conn = open_connection()
+    try:
+        cur = execute_search(conn.cursor(), plan, values, rank_words, top_k)
+        header = get_header(cur)
+        if rank_words is not None:
+            results = cur.fetchall()
+            conn.close()
+            return (header, iter(results))
+    except BaseException:
+        conn.close()
+        raise
+
+    def rows():
+        try:
+            while True:
+                batch = cur.fetchmany(batch_size)
+                if not batch:
+                    return
+                yield from batch
+        finally:
+            conn.close()
+    generator = rows()
+    # A generator that is never started does not run its finally
+    weakref.finalize(generator, conn.close)
+    return (header, generator)
+
+def encode_cursor(key):
+    """
+    Encode the sort key of the last row of a page as an opaque token.
+    """
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(token):
+    """
+    Decode a token of encode_cursor, raising ValueError if it is not one.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor: {!r}".format(token)) from e
+    if not isinstance(key, list) or not key:
+        raise ValueError("invalid cursor: {!r}".format(token))
+    return key
+
+def find_courses_page(args_from_ui, limit=PAGE_SIZE, cursor=None):
+    """
+    Finds one page of the courses matching the specified search criteria
+    (see search_courses), with keyset pagination: the rows are ordered by
+    course id (and section id, if they have sections), and a page starts
+    after the sort key in cursor, so that fetching any page takes at most
+    limit rows, however many rows match.
+
+    Inputs:
+        limit: largest number of rows of the page, at least 1
+        cursor: None for the first page, or the next_cursor of the
+          previous page
+
+    Returns:
+        (header, rows, next_cursor) triple, where next_cursor is None on
+        the last page
+    """
+    if limit < 1:
+        raise ValueError("invalid page limit: {!r}".format(limit))
+    if not args_from_ui:
+        return ([], [], None)
+    key = decode_cursor(cursor) if cursor is not None else None
+    plan, values, _ = plan_search(args_from_ui, paged=True, after=key is not None)
+    if key is not None:
+        if len(key) != plan.num_keys:
+            raise ValueError("invalid cursor: {!r}".format(cursor))
+        values.extend(key)
+    # One more row tells whether there is a next page
+    values.append(limit + 1)
+    cur = get_connection().cursor()
+    rows = cur.execute(plan.sql, values).fetchall()
+    header = get_header(cur)[:-plan.num_keys]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1][-plan.num_keys:]))
+    return (header, [row[:-plan.num_keys] for row in rows], next_cursor)
+
+def find_courses_many(list_of_args, top_k=None):
+    """
+    Finds the courses of several searches (see search_courses).
+
+    Repeated searches run once, and the result cache answers the ones
+    it has.  The others run one after the other on one cursor: there is
+    no work shared between them beyond the statement cache of the
+    connection, which compiles the SQL of each query shape once.
+
+    Returns:
+        list of (header, rows) pairs, in the order of list_of_args
+    """
+    results = [None] * len(list_of_args)
+    pending = OrderedDict()  # normalized args -> indexes of the searches
+    for i, args_from_ui in enumerate(list_of_args):
+        key = normalize_args(args_from_ui, top_k)
+        if key in pending:
+            pending[key].append(i)
+            continue
+        cached = result_cache.get(key) if args_from_ui else ([], [])
+        if cached is None:
+            pending[key] = [i]
+        else:
+            results[i] = cached
+
+    cur = get_connection().cursor()
+    for key, indexes in pending.items():
+        plan, values, rank_words = plan_search(list_of_args[indexes[0]], top_k)
+        result = run_search(cur, plan, values, rank_words, top_k)
+        result_cache.put(key, result)
+        for i in indexes:
+            results[i] = result
+    return [(list(header), list(rows)) for header, rows in results]
+
+def get_executor():
+    """
+    Return the executor of find_courses_async, starting it on first use.
+    Its ASYNC_WORKERS threads bound the number of searches running at
+    once; each one has its own connection (see get_connection).
+    """
+    with _executor_lock:
+        if _executor[0] is None:
+            _executor[0] = ThreadPoolExecutor(max_workers=ASYNC_WORKERS,
+                                              thread_name_prefix="find_courses")
+        return _executor[0]
+
+async def find_courses_async(args_from_ui, top_k=None):
+    """
+    Run find_courses on the executor (see get_executor), without
+    blocking the event loop.  Several searches awaited together, as with
+    asyncio.gather, run concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(),
+                                      functools.partial(find_courses, args_from_ui, top_k))
+
+async def find_courses_many_async(list_of_args, top_k=None):
+    """
+    Run find_courses_many on the executor, without blocking the event
+    loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(),
+                                      functools.partial(find_courses_many, list_of_args, top_k))
+
 
 
 ########### auxiliary functions #################
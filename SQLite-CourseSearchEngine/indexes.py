@@ -0,0 +1,109 @@
+'''
+Course search engine: indexes of the course database
+
+Advises and creates the indexes find_courses needs, and reports the
+queries that scan whole tables.
+
+Usage:
+    python3 indexes.py [DATABASE] [--dry-run]
+'''
+
+import argparse
+import sqlite3
+import re
+
+import courses
+
+
+# (name, table, columns) of the indexes find_courses uses.  The leading
+# columns are the ones searched or joined on; the rest make the index
+# covering, so the table itself is not read.
+INDEXES = [
+    ("courses_dept", "courses", ["dept", "course_id"]),
+    ("courses_course_id", "courses", ["course_id", "dept", "course_num", "title"]),
+    # Also gives the rows of a page of find_courses_page in order
+    ("sections_course_id", "sections", ["course_id", "section_id", "meeting_pattern_id"]),
+    ("meeting_patterns_id", "meeting_patterns",
+     ["meeting_pattern_id", "day", "time_start", "time_end"]),
+    ("catalog_index_word", "catalog_index", ["word", "course_id"]),
+    ("gps_building_code", "gps", ["building_code", "lon", "lat"]),
+]
+
+# A step of a query plan that reads a whole table; json_each and other
+# virtual tables are not stored tables
+FULL_SCAN_RE = re.compile(r'^SCAN (\w+)\b(?! VIRTUAL TABLE)')
+
+
+def missing_indexes(conn):
+    """
+    Return the statements that create the indexes of INDEXES that the
+    database on conn lacks, for the tables it has, and that rebuild the
+    ones it has on other columns.
+    """
+    tables = {name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    indexes = {name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")}
+    statements = []
+    for name, table, columns in INDEXES:
+        if table not in tables:
+            continue
+        if name in indexes:
+            if [row[2] for row in conn.execute(f"PRAGMA index_info({name})")] == columns:
+                continue
+            statements.append("DROP INDEX {}".format(name))
+        statements.append("CREATE INDEX {} ON {} ({})".format(name, table, ", ".join(columns)))
+    return statements
+
+
+def create_indexes(db_filename, dry_run=False):
+    """
+    Create the missing indexes of the database and update the statistics
+    of the query planner (ANALYZE), in a single transaction.
+
+    Inputs:
+        db_filename: name of the database file
+        dry_run: only return the statements, without running them
+
+    Returns:
+        list of the statements run
+    """
+    conn = sqlite3.connect(db_filename, isolation_level=None)
+    try:
+        statements = missing_indexes(conn)
+        if not dry_run:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute("ANALYZE")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
+    # The schema changed
+    courses.clear_plans()
+    return statements
+
+
+def full_scans(args_from_ui):
+    """
+    Return the tables the query of find_courses(args_from_ui) reads in
+    full, according to its EXPLAIN QUERY PLAN (see courses.explain).
+    """
+    return [match.group(1) for match in
+            (FULL_SCAN_RE.match(detail) for detail in courses.explain(args_from_ui))
+            if match]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument("database", nargs="?", default=courses.DATABASE_FILENAME)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print the indexes that would be created")
+    args = parser.parse_args()
+
+    for statement in create_indexes(args.database, args.dry_run):
+        print(statement)
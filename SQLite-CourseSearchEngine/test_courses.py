@@ -2,15 +2,27 @@
 Tests for finding courses
 '''
 
+import asyncio
+import gc
 import json
 import os
+import random
+import shutil
+import sqlite3
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 
 
 # DO NOT REMOVE THESE LINES OF CODE
 # pylint: disable= broad-except, redefined-outer-name
 
-from courses import find_courses
+from courses import find_courses, max_score_top_k
+import courses
+import indexes
+import walking_times
+from bitmap import Bitmap, TermIndex, intersect
 
 TEST_DIR = os.path.dirname(__file__)
 TEST_FILENAME = os.path.join(TEST_DIR, 'find_courses_tests.json')
@@ -132,3 +144,350 @@ def test_n(t):
     check_type(actual, err_msg, t["input"])
     check_header(expected, actual, err_msg, t["input"])
     check_rows(expected, actual, err_msg, t["input"])
+
+
+@pytest.fixture
+def db_copy(tmp_path, monkeypatch):
+    '''
+    Point courses at a copy of the course database, which the test may
+    change, and return its filename.
+    '''
+    db_filename = str(tmp_path / "courses.sqlite3")
+    shutil.copy(courses.DATABASE_FILENAME, db_filename)
+    monkeypatch.setattr(courses, "DATABASE_FILENAME", db_filename)
+    return db_filename
+
+
+def test_phrase_terms(db_copy):
+    '''
+    Check phrase and proximity terms against a positional index.
+    '''
+    db = sqlite3.connect(db_copy)
+    db.execute("CREATE TABLE catalog_positions "
+               "(course_id integer, word varchar(100), positions blob)")
+    db.execute("CREATE TABLE catalog_stop_words (word varchar(100))")
+    db.executemany("INSERT INTO catalog_stop_words VALUES (?)", [("of",), ("the",)])
+    # positions are delta-encoded: [1, 2] is 01 01
+    db.executemany("INSERT INTO catalog_positions VALUES (?, ?, ?)", [
+        (1, "discovering", bytes([0])), (1, "anthropology", bytes([1])),
+        (1, "culture", bytes([2])), (1, "history", bytes([10])),
+        (1, "art", bytes([12])),
+        (2, "discovering", bytes([0])), (2, "anthropology", bytes([3])),
+        (3, "history", bytes([5])), (3, "art", bytes([6]))])
+    db.commit()
+    db.close()
+
+    def course_nums(terms):
+        return sorted(row[1] for row in find_courses({"terms": terms})[1])
+
+    assert course_nums(["Discovering Anthropology"]) == ["20002"]
+    assert course_nums(["discovering anthropology~2"]) == ["20002", "20003"]
+    assert course_nums(["anthropology discovering"]) == []
+    # stop words keep their place in the phrase
+    assert course_nums(["history of art"]) == ["20002"]
+    assert course_nums(["history art"]) == ["20100"]
+    assert course_nums(["discovering anthropology~2", "race"]) == ["20003"]
+    # a phrase of stop words only matches nothing, like a stop word
+    assert course_nums(["of the"]) == course_nums(["the"]) == []
+    assert find_courses({"terms": ["of the"], "dept": "CMSC"})[1] == []
+
+
+def test_max_score_top_k():
+    '''
+    Check that MaxScore pruning returns the same top k as scoring every course.
+    '''
+    rnd = random.Random(0)
+    for _ in range(200):
+        postings = []
+        for _ in range(rnd.randint(1, 5)):
+            course_ids = sorted(rnd.sample(range(100), rnd.randint(0, 60)))
+            scores = [rnd.randint(1, 8) / 2 for _ in course_ids]
+            postings.append((max(scores, default=0.0), course_ids, scores))
+        allowed = set(rnd.sample(range(100), 50)) if rnd.random() < 0.3 else None
+        k = rnd.randint(1, 20)
+
+        totals = {}
+        for _, course_ids, scores in postings:
+            for course_id, score in zip(course_ids, scores):
+                totals[course_id] = totals.get(course_id, 0.0) + score
+        expected = sorted(((course_id, score) for course_id, score in totals.items()
+                           if allowed is None or course_id in allowed),
+                          key=lambda pair: (-pair[1], pair[0]))[:k]
+        assert max_score_top_k(postings, k, allowed) == expected
+    assert max_score_top_k([(1.0, [1, 2], [1.0, 0.5])], 0) == []
+
+
+def test_ranked_terms():
+    '''
+    Check that a ranked search returns at most k courses, best first.
+    '''
+    header, rows = find_courses({"terms": ["history", "art", "modern"]}, top_k=5)
+    assert header == ["dept", "course_num", "title", "score"]
+    assert len(rows) == 5
+    assert [row[-1] for row in rows] == sorted((row[-1] for row in rows), reverse=True)
+    _, rows = find_courses({"terms": ["history", "art"], "dept": "ARTH"}, top_k=5)
+    assert rows and all(row[0] == "ARTH" for row in rows)
+    assert find_courses({"terms": ["history"]}, top_k=0) == (header, [])
+
+    # Ranking does not change the connection while another statement on
+    # it is still reading
+    active = courses.get_connection().execute("SELECT course_id FROM courses")
+    assert active.fetchone()
+    assert courses.search_courses({"terms": ["history"]}, top_k=3)[1]
+    assert active.fetchone()
+    active.close()
+
+
+def test_concurrent_searches():
+    '''
+    Check that searches from several threads return the same results as
+    serial ones, on read-only connections.
+    '''
+    inputs = [t["input"] for t in TESTS] * 4
+    expected = [find_courses(args) for args in inputs]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        # Past the result cache
+        assert list(pool.map(courses.search_courses, inputs)) == expected
+    with pytest.raises(sqlite3.OperationalError):
+        courses.get_connection().execute("DELETE FROM courses")
+    courses.close_connections()
+    assert find_courses(inputs[1]) == expected[1]
+
+
+def test_thread_connections_closed():
+    '''
+    Check that the connection of a thread is closed when the thread exits,
+    so short-lived threads do not pile up open connections.
+    '''
+    def search():
+        courses.search_courses({"dept": "CMSC"})
+
+    courses.get_connection()
+    before = len(courses._holders)
+    for _ in range(100):
+        thread = threading.Thread(target=search)
+        thread.start()
+        thread.join()
+    gc.collect()
+    assert len(courses._holders) == before
+    if os.path.isdir("/proc/self/fd"):
+        num_fds = len(os.listdir("/proc/self/fd"))
+        for _ in range(50):
+            thread = threading.Thread(target=search)
+            thread.start()
+            thread.join()
+        gc.collect()
+        assert len(os.listdir("/proc/self/fd")) <= num_fds + 2
+
+
+def test_query_plans():
+    '''
+    Check that the SQL of a query shape is generated once and reused for
+    other values and key orders.
+    '''
+    courses.clear_plans()
+    args = {"dept": "CMSC", "day": ["MWF"], "time_start": 1030}
+    expected = find_courses(args)
+    reordered = {"time_start": 1030, "day": ["MWF", "TR"], "dept": "MATH"}
+    find_courses(reordered)
+    info = courses.plan_query.cache_info()
+    assert (info.misses, info.hits) == (1, 1)
+    assert find_courses(dict(reversed(list(args.items())))) == expected
+    assert courses.find_common_variable("courses", "sections") == "course_id"
+
+
+def test_catalog_schema_changes(db_copy):
+    '''
+    Check that the schema catalog and the query plans are loaded again
+    when another connection changes the schema.
+    '''
+    expected = find_courses({"dept": "CMSC"})
+    assert not courses.get_catalog().has_table("extra")
+    assert courses.plan_query.cache_info().currsize > 0
+
+    conn = sqlite3.connect(db_copy)
+    conn.execute("CREATE TABLE extra (course_id integer)")
+    conn.commit()
+    conn.close()
+    assert courses.get_catalog().has_table("extra")
+    assert courses.plan_query.cache_info().currsize == 0
+    assert courses.search_courses({"dept": "CMSC"}) == expected
+
+
+def test_query_plans_use_indexes():
+    '''
+    Check that the database has the indexes of indexes.INDEXES, and that
+    no query of the tests reads a whole table.
+    '''
+    conn = sqlite3.connect(courses.DATABASE_FILENAME)
+    assert indexes.missing_indexes(conn) == []
+    conn.close()
+    for t in TESTS:
+        scans = indexes.full_scans(t["input"])
+        assert not scans, "Test #{}: full scan of {}\n{}".format(
+            t["test_num"], scans, "\n".join(courses.explain(t["input"])))
+
+
+def test_walking_times(db_copy):
+    '''
+    Check that the walking_times table gives the walking times
+    find_courses computes, and that a change to gps makes it stale until
+    it is refreshed.
+    '''
+    conn = sqlite3.connect(db_copy)
+    conn.execute("DELETE FROM walking_times_meta")
+    conn.commit()
+    courses.clear_plans()
+
+    inputs = [{"building_code": code, "walking_time": minutes, "dept": dept}
+              for code in ["RY", "HM"] for minutes in [0, 3, 10, 61]
+              for dept in ["CMSC", "MATH"]]
+    expected = [sorted(find_courses(args)[1]) for args in inputs]
+    assert walking_times.refresh_walking_times(db_copy) > 0
+    assert walking_times.refresh_walking_times(db_copy) is None
+    assert courses.use_walking_times({"building_code": "RY", "walking_time": 10})
+    assert [sorted(find_courses(args)[1]) for args in inputs] == expected
+
+    conn.execute("UPDATE gps SET lat = lat + 0.01 WHERE building_code = 'RY'")
+    conn.commit()
+    assert not courses.use_walking_times({"building_code": "RY", "walking_time": 10})
+    moved = [sorted(find_courses(args)[1]) for args in inputs]
+    assert walking_times.refresh_walking_times(db_copy) > 0
+    assert [sorted(find_courses(args)[1]) for args in inputs] == moved
+
+    # A new gps table has no triggers: the hash of its rows tells
+    conn.execute("CREATE TABLE gps_new AS SELECT * FROM gps")
+    conn.execute("UPDATE gps_new SET lat = lat - 0.01 WHERE building_code = 'RY'")
+    conn.execute("DROP TABLE gps")
+    conn.execute("ALTER TABLE gps_new RENAME TO gps")
+    conn.commit()
+    assert not courses.use_walking_times({"building_code": "RY", "walking_time": 10})
+    assert [sorted(find_courses(args)[1]) for args in inputs] == expected
+    assert walking_times.refresh_walking_times(db_copy) > 0
+    assert courses.use_walking_times({"building_code": "RY", "walking_time": 10})
+    assert [sorted(find_courses(args)[1]) for args in inputs] == expected
+    conn.close()
+
+
+def test_bitmaps():
+    '''
+    Check bitmap intersections against sets, with sparse and dense
+    containers, and that term searches go through the term index.
+    '''
+    rng = random.Random(0)
+    for _ in range(50):
+        size = rng.choice([100, 10000, 200000])
+        sets = [set(rng.sample(range(size), min(size, rng.choice([10, 50, 5000, 9000]))))
+                for _ in range(rng.randint(1, 3))]
+        bitmaps = [Bitmap(values) for values in sets]
+        expected = set.intersection(*sets)
+        result = intersect(bitmaps)
+        assert list(result) == sorted(expected)
+        assert len(result) == len(expected)
+        assert all(value in bitmaps[0] for value in sets[0])
+
+    index = TermIndex([("art", 1), ("art", 2), ("history", 2), ("history", 2)])
+    assert index.courses_with_all(["art", "history"]) == [2]
+    assert index.courses_with_all(["art", "unknown"]) == []
+    assert index.num_courses == 2
+    assert find_courses({"terms": ["computer", "science"]})[1] == \
+        find_courses({"terms": ["science", "computer", "science"]})[1]
+    assert courses.get_term_index() is courses.get_term_index()
+    assert courses.get_term_index().num_courses == courses.get_connection().execute(
+        "SELECT COUNT(DISTINCT course_id) FROM catalog_index").fetchone()[0]
+
+
+def test_result_cache(db_copy, monkeypatch):
+    '''
+    Check that the result cache answers repeated searches in any order,
+    evicts the least recently used ones and expires old ones, and is
+    emptied when the database changes.
+    '''
+    now = [0.0]
+    cache = courses.ResultCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    monkeypatch.setattr(courses, "result_cache", cache)
+    args = {"dept": "CMSC", "day": ["MWF", "TR"], "time_start": 1030}
+    expected = find_courses(args)
+    assert find_courses({"time_start": 1030, "day": ["TR", "MWF"], "dept": "CMSC"}) == expected
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+    find_courses({"dept": "MATH"})
+    find_courses({"dept": "ECON"})
+    assert cache.stats["evictions"] == 1
+    now[0] = 11
+    find_courses({"dept": "ECON"})
+    assert cache.stats["expirations"] == 1
+
+    rows = find_courses({"dept": "CMSC"})[1]
+    conn = sqlite3.connect(db_copy)
+    conn.execute("DELETE FROM courses WHERE dept = 'CMSC'")
+    conn.commit()
+    conn.close()
+    assert rows and find_courses({"dept": "CMSC"})[1] == []
+    assert cache.stats["invalidations"] >= 1
+
+
+def test_find_courses_many():
+    '''
+    Check that batched and async searches return what find_courses
+    returns, in order.
+    '''
+    inputs = [t["input"] for t in TESTS] * 2 + [{"terms": ["history", "art"]}]
+    courses.result_cache.clear()
+    results = courses.find_courses_many(inputs)
+    assert results == [courses.search_courses(args) for args in inputs]
+    for t, (header, rows) in zip(TESTS, results):
+        check_header(t["expected"], (header, rows), "", t["input"])
+        check_rows(t["expected"], (header, rows), "", t["input"])
+    ranked = courses.find_courses_many(inputs[-1:], top_k=5)
+    assert ranked == [find_courses(inputs[-1], top_k=5)]
+
+    async def search_all():
+        return await asyncio.gather(*[courses.find_courses_async(args) for args in inputs],
+                                    courses.find_courses_many_async(inputs))
+    gathered = asyncio.run(search_all())
+    assert gathered[:-1] == results and gathered[-1] == results
+
+
+def test_stream_and_pages():
+    '''
+    Check that streamed rows and the rows of every page, in order, are
+    the rows of find_courses, and that pages do not sort the whole match
+    set.
+    '''
+    inputs = [t["input"] for t in TESTS] + [{"enrollment": [0, 1000]}, {"terms": ["history"]}]
+    for args in inputs:
+        header, rows = find_courses(args)
+        streamed_header, streamed = courses.stream_courses(args, batch_size=7)
+        assert isinstance(streamed, types.GeneratorType) or not args
+        assert streamed_header == header
+        assert sorted(streamed) == sorted(rows)
+        for limit in [1, 10]:
+            paged = []
+            cursor = None
+            while True:
+                page_header, page, cursor = courses.find_courses_page(args, limit, cursor)
+                assert len(page) <= limit and page_header == header
+                paged.extend(page)
+                if cursor is None:
+                    break
+            assert sorted(paged) == sorted(rows) and len(paged) == len(rows)
+
+    # A stream keeps reading next to ranked searches and after the
+    # thread's connections are closed
+    header, rows = find_courses({"enrollment": [0, 1000]})
+    _, streamed = courses.stream_courses({"enrollment": [0, 1000]}, batch_size=5)
+    first = [next(streamed) for _ in range(10)]
+    assert courses.search_courses({"terms": ["history"]}, top_k=3)[1]
+    assert courses.search_courses({"terms": ["art"]}, top_k=3)[1]
+    courses.close_connections()
+    assert sorted(first + list(streamed)) == sorted(rows)
+
+    with pytest.raises(ValueError):
+        courses.find_courses_page({"dept": "CMSC"}, cursor="not a cursor")
+    for limit in [0, -3]:
+        with pytest.raises(ValueError):
+            courses.find_courses_page({"dept": "CMSC"}, limit)
+    plan, values, _ = courses.plan_search({"enrollment": [0, 1000]}, paged=True, after=True)
+    steps = courses.get_connection().execute(
+        "EXPLAIN QUERY PLAN " + plan.sql, values + [0, "", 26]).fetchall()
+    assert not any("ORDER BY" in step[3] for step in steps)
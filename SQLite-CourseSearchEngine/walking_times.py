@@ -0,0 +1,163 @@
+'''
+Course search engine: walking times between buildings
+
+Materializes the walking time between every two buildings of the gps
+table that are at most MAX_WALKING_TIME minutes apart, so that
+find_courses looks them up in an index instead of computing them for
+every row it joins.
+
+The table records a hash of the gps rows it was computed from (see
+courses.gps_hash), and triggers on gps mark it stale when a building is
+added, moved or removed.  When gps no longer matches, for instance
+because the table was replaced, find_courses computes the walking times
+again until the table is refreshed.
+
+Usage:
+    python3 walking_times.py [DATABASE] [--max-time MINUTES] [--force]
+'''
+
+import argparse
+import sqlite3
+from bisect import bisect_left, bisect_right
+from math import radians, degrees, cos, sin, asin, pi
+
+import courses
+
+
+# Walking times above this many minutes are computed by find_courses
+MAX_WALKING_TIME = 60
+# Meters walked per minute, and radius of the Earth in meters, as in
+# courses.compute_time_between and courses.haversine
+METERS_PER_MIN = 1.1 * 60
+EARTH_RADIUS = 6367 * 1000
+
+SCHEMA = [
+    "DROP TABLE IF EXISTS walking_times",
+    "CREATE TABLE walking_times (building_code varchar(5), other_code varchar(5), "
+    "walking_time integer)",
+    "DROP TABLE IF EXISTS walking_times_meta",
+    "CREATE TABLE walking_times_meta (max_time integer, gps_hash text)",
+]
+INDEXES = [
+    "CREATE INDEX walking_times_building ON walking_times "
+    "(building_code, walking_time, other_code)",
+    "CREATE INDEX walking_times_other ON walking_times "
+    "(other_code, building_code, walking_time)",
+]
+# Any change to gps makes the walking times stale
+TRIGGERS = ["CREATE TRIGGER IF NOT EXISTS gps_walking_times_{0} AFTER {0} ON gps "
+            "BEGIN DELETE FROM walking_times_meta; END".format(event)
+            for event in ["INSERT", "UPDATE", "DELETE"]]
+
+
+def bounding_box(max_time, max_lat):
+    '''
+    Compute the largest latitude and longitude differences, in degrees,
+    of two buildings at most max_time minutes apart.
+
+    Inputs:
+        max_time: walking time in minutes
+        max_lat: largest absolute latitude of the two buildings, in degrees
+
+    Returns:
+        (dlat, dlon) pair
+    '''
+    # haversine(...) >= EARTH_RADIUS * dlat, and, since sin(dlat / 2) ** 2
+    # is not negative, >= 2 * EARTH_RADIUS * asin(cos(lat) * sin(dlon / 2))
+    angle = max_time * METERS_PER_MIN / EARTH_RADIUS
+    if angle >= pi:
+        return 180.0, 360.0
+    dlat = degrees(angle)
+    half = sin(angle / 2) / cos(radians(max_lat))
+    dlon = 360.0 if half >= 1 else degrees(2 * asin(half))
+    # Keep pairs on the edge of the box; the exact time decides
+    return dlat * (1 + 1e-9), dlon * (1 + 1e-9)
+
+
+def walking_time_rows(buildings, max_time=MAX_WALKING_TIME):
+    '''
+    Compute the walking times of the pairs of buildings at most max_time
+    minutes apart, with courses.compute_time_between.  Only the pairs in
+    the bounding box of max_time (see bounding_box) are computed.
+
+    Inputs:
+        buildings: list of (building_code, lon, lat) rows of gps
+
+    Returns:
+        list of (building_code, other_code, walking_time) rows, with
+        the time from other_code to building_code
+    '''
+    by_lat = sorted(buildings, key=lambda building: building[2])
+    lats = [lat for _, _, lat in by_lat]
+    max_lat = max((abs(lat) for lat in lats), default=0.0)
+    dlat, dlon = bounding_box(max_time, max_lat)
+
+    rows = []
+    for code, lon, lat in buildings:
+        for other_code, other_lon, other_lat in by_lat[bisect_left(lats, lat - dlat):
+                                                       bisect_right(lats, lat + dlat)]:
+            if abs(other_lon - lon) > dlon:
+                continue
+            # Same argument order as the join of find_courses: from the
+            # section's building to the one searched for
+            time = courses.compute_time_between(other_lon, other_lat, lon, lat)
+            if time <= max_time:
+                rows.append((code, other_code, time))
+    return rows
+
+
+def refresh_walking_times(db_filename, max_time=MAX_WALKING_TIME, force=False):
+    '''
+    Recompute the walking_times table if gps changed since it was
+    computed (or it was computed with another max_time, or before it
+    recorded the hash of gps), in a single transaction.
+
+    Returns:
+        the number of rows computed, or None if the table was up to date
+    '''
+    conn = sqlite3.connect(db_filename, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            has_meta = any(column[1] == "gps_hash" for column in
+                           conn.execute("PRAGMA table_info(walking_times_meta)"))
+            row = has_meta and conn.execute(
+                "SELECT max_time, gps_hash FROM walking_times_meta").fetchone()
+            current_hash = courses.gps_hash(conn)
+            if row and row == (max_time, current_hash) and not force:
+                conn.execute("ROLLBACK")
+                return None
+            rows = walking_time_rows(
+                conn.execute("SELECT building_code, lon, lat FROM gps").fetchall(), max_time)
+            for sql in SCHEMA:
+                conn.execute(sql)
+            conn.executemany("INSERT INTO walking_times VALUES (?, ?, ?)", rows)
+            for sql in INDEXES + TRIGGERS:
+                conn.execute(sql)
+            conn.execute("INSERT INTO walking_times_meta VALUES (?, ?)",
+                         (max_time, current_hash))
+            conn.execute("ANALYZE walking_times")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    # The schema changed
+    courses.clear_plans()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument("database", nargs="?", default=courses.DATABASE_FILENAME)
+    parser.add_argument("--max-time", type=int, default=MAX_WALKING_TIME)
+    parser.add_argument("--force", action="store_true",
+                        help="recompute the walking times even if gps did not change")
+    args = parser.parse_args()
+
+    num_rows = refresh_walking_times(args.database, args.max_time, args.force)
+    if num_rows is None:
+        print("walking times are up to date")
+    else:
+        print("{} walking times computed".format(num_rows))
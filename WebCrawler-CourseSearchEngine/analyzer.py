@@ -0,0 +1,79 @@
+"""
+Tokenizer for the text of course blocks.
+"""
+# pylint: disable-msg=invalid-name
+
+import re
+import sys
+
+# Letters followed by letters, numbers, underscores or dashes
+WORD_RE = re.compile(r'\b([a-zA-Z][\w\-]*)\b')
+
+
+def load_stop_words(filename):
+    '''
+    Read a stop-word list: one word per line, blank lines and lines
+    starting with # are ignored.
+    '''
+    with open(filename) as f:
+        return set(line.strip().lower() for line in f
+                   if line.strip() and not line.startswith("#"))
+
+
+class Analyzer:
+    '''
+    Turns text into index terms: lowercase words, without stop words.
+
+    Terms are interned, so that each distinct term is stored once however
+    many courses it appears in.  terms() keeps repeated words, so that the
+    terms of several pieces of text can be tokenized once and combined
+    with unique(): the terms of "a b" are the terms of "a" followed by
+    the terms of "b".
+    '''
+
+    def __init__(self, stop_words):
+        self.stop_words = frozenset(stop_words)
+
+    def terms(self, text):
+        '''
+        Return the list of terms of text, in order, with repeats.
+        '''
+        stop_words = self.stop_words
+        return [sys.intern(word) for word in WORD_RE.findall(text.lower())
+                if word not in stop_words]
+
+    def positions(self, text):
+        '''
+        Return the terms of text with their positions, and the number of
+        words in text.  Stop words are left out but keep their position,
+        so that the distance between two terms is the distance between
+        the words in the text.
+
+        Returns:
+            (dict of term -> list of positions, number of words) pair
+        '''
+        stop_words = self.stop_words
+        term_positions = {}
+        words = WORD_RE.findall(text.lower())
+        for position, word in enumerate(words):
+            if word not in stop_words:
+                term_positions.setdefault(sys.intern(word), []).append(position)
+        return term_positions, len(words)
+
+    @staticmethod
+    def unique(*term_lists):
+        '''
+        Concatenate lists of terms, keeping the first occurrence of each
+        term.
+        '''
+        seen = {}
+        for terms in term_lists:
+            seen.update(dict.fromkeys(terms))
+        return list(seen)
+
+    def extract_words(self, text):
+        '''
+        Return the list of distinct terms of text, in order of first
+        occurrence.
+        '''
+        return list(dict.fromkeys(self.terms(text)))
@@ -0,0 +1,159 @@
+"""
+Benchmark of the crawler against a local synthetic catalog
+(bench_server.py).
+
+The catalog server runs in a separate process, and every run crawls in
+a fresh process of its own, so the CPU time and peak memory reported are
+those of that crawl alone.  Each run reports the pages crawled per
+second, the CPU time, the peak RSS and the per-stage timings collected
+by the crawler's metrics.
+
+Usage:
+    python3 bench_crawler.py [--pages N] [--latency SECONDS] [--error-rate FRACTION]
+        [--workers N] [--adaptive] [--index-workers N] [--parser NAME]
+        [--repeat N] [--output FILE]
+"""
+# pylint: disable-msg=invalid-name
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import functools
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import crawler
+import parsing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+COURSE_MAP_FILENAME = os.path.join(BENCH_DIR, "course_map.json")
+
+
+def start_server_process(num_pages, seed=0, latency=0.0, error_rate=0.0):
+    '''
+    Start bench_server.py in a child process.
+
+    Returns:
+        (process, starting_url, limiting_domain) triple
+    '''
+    server_filename = os.path.join(BENCH_DIR, "bench_server.py")
+    process = subprocess.Popen(
+        [sys.executable, server_filename, "--port", "0", "--pages", str(num_pages),
+         "--seed", str(seed), "--latency", str(latency),
+         "--error-rate", str(error_rate)],
+        stdout=subprocess.PIPE, text=True,
+        cwd=os.path.dirname(server_filename))
+    starting_url, limiting_domain = process.stdout.readline().split()
+    return process, starting_url, limiting_domain
+
+
+def run_once(num_pages, starting_url, limiting_domain, **options):
+    '''
+    Crawl the catalog once and measure the crawl, in the calling process
+    (see run_in_process).
+
+    Returns:
+        dict with the measurements of the run
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_filename = os.path.join(tmp_dir, "catalog_index.csv")
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        metrics = crawler.go(num_pages, COURSE_MAP_FILENAME, index_filename,
+                             starting_url=starting_url,
+                             limiting_domain=limiting_domain, **options)
+        elapsed = time.perf_counter() - start
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    report = metrics.report()
+    pages = report["counters"].get("pages", 0)
+    return {
+        "pages": pages,
+        "elapsed": elapsed,
+        "pages_per_sec": pages / elapsed if elapsed > 0 else 0.0,
+        "cpu_user": usage_after.ru_utime - usage_before.ru_utime,
+        "cpu_system": usage_after.ru_stime - usage_before.ru_stime,
+        # index worker processes (index_workers > 1) of this run; the
+        # counts of RUSAGE_CHILDREN add up over the whole process
+        "cpu_children": (children_after.ru_utime - children_before.ru_utime +
+                         children_after.ru_stime - children_before.ru_stime),
+        # Highest RSS of the calling process so far, and of its largest
+        # child (an index worker); ru_maxrss is in kilobytes on Linux.
+        # Only the measurements of a run in a fresh process (see
+        # run_in_process) are those of the run alone.
+        "peak_rss_mb": usage_after.ru_maxrss / 1024,
+        "peak_rss_children_mb": children_after.ru_maxrss / 1024,
+        "stages": {name: timer["total"] for name, timer in report["timers"].items()},
+        "counters": report["counters"],
+        "failures": report["failures"],
+    }
+
+
+def run_in_process(num_pages, starting_url, limiting_domain, **options):
+    '''
+    Run run_once in a fresh process, so that its peak RSS and child
+    measurements are not those of earlier runs.
+    '''
+    with ProcessPoolExecutor(max_workers=1,
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(functools.partial(run_once, num_pages, starting_url,
+                                             limiting_domain, **options)).result()
+
+
+def go(num_pages, latency=0.0, error_rate=0.0, seed=0, repeat=1, **options):
+    '''
+    Start the catalog server and crawl it repeat times.
+
+    Returns:
+        list of the measurements of each run
+    '''
+    process, starting_url, limiting_domain = start_server_process(num_pages, seed, latency,
+                                                                  error_rate)
+    try:
+        return [run_in_process(num_pages, starting_url, limiting_domain, **options)
+                for _ in range(repeat)]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the server waits before each response")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of the requests the server fails with a 500")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument("--index-workers", type=int, default=1)
+    parser.add_argument("--parser", default=parsing.DEFAULT_PARSER,
+                        choices=sorted(parsing.PARSERS))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default=None,
+                        help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = go(args.pages, latency=args.latency, error_rate=args.error_rate,
+                 seed=args.seed, repeat=args.repeat, num_workers=args.workers,
+                 adaptive=args.adaptive, index_workers=args.index_workers,
+                 parser=args.parser)
+    for i, result in enumerate(results):
+        print("run {}: {} pages in {:.2f}s ({:.1f} pages/sec), cpu {:.2f}s user "
+              "{:.2f}s system, {:.2f}s index workers, peak RSS {:.1f} MB "
+              "(index workers {:.1f} MB)".format(
+                  i + 1, result["pages"], result["elapsed"], result["pages_per_sec"],
+                  result["cpu_user"], result["cpu_system"], result["cpu_children"],
+                  result["peak_rss_mb"], result["peak_rss_children_mb"]))
+        print("  stages: " + ", ".join("{} {:.2f}s".format(name, total)
+                                       for name, total in sorted(result["stages"].items())))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
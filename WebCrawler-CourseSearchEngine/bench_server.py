@@ -0,0 +1,239 @@
+"""
+Local HTTP server for a synthetic college catalog, for benchmarking and
+testing the crawler without the network.
+
+The catalog has an index page that links to num_pages - 1 department
+pages.  Each department page has course blocks shaped like the real
+catalog's (titles with course codes from course_map.json, sequences
+with subsequence blocks, cross-listed courses) and links to other
+department pages, pages outside the domain, mailto and fragment links.
+Pages are generated from the seed on request, so the same options
+always serve the same catalog.  They are UTF-8, with some non-ASCII
+words; odd department pages do not declare their charset, so the
+crawler has to detect it.
+
+Usage:
+    python3 bench_server.py [--port PORT] [--pages N] [--seed S]
+        [--latency SECONDS] [--error-rate FRACTION]
+"""
+# pylint: disable-msg=invalid-name
+
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+INDEX_PATH = "/catalog/index.html"
+DEPT_PATH = "/catalog/thecollege/dept-{}/"
+
+VOCABULARY = ("history language analysis machine learning theory practice "
+              "modern ancient culture society data computation art music "
+              "science literature politics economy introduction advanced "
+              "seminar research methods structure evolution twentieth "
+              "century portuguese british classical drawing honors essay "
+              "statistics programming systems networks algorithms biology "
+              "chemistry physics philosophy religion law medicine media "
+              "naïve café façade résumé").split()
+
+
+class SyntheticCatalog:
+    '''
+    Deterministic synthetic catalog.
+
+    Inputs:
+        course_codes: list of course codes to use in course titles
+        num_pages: number of pages, including the index page
+        seed: random seed
+        courses_per_page: mean number of course blocks per department page
+        fan_out: mean number of links to other department pages per page
+    '''
+
+    def __init__(self, course_codes, num_pages=1000, seed=0,
+                 courses_per_page=8, fan_out=8):
+        self.course_codes = sorted(course_codes)
+        self.num_depts = max(num_pages - 1, 0)
+        self.seed = seed
+        self.courses_per_page = courses_per_page
+        self.fan_out = fan_out
+
+    def _code(self, i):
+        return self.course_codes[i % len(self.course_codes)]
+
+    def _words(self, rnd, n):
+        return " ".join(rnd.choice(VOCABULARY) for _ in range(n))
+
+    def _block(self, p, title, description):
+        return ('<div class="courseblock {}">\n'
+                '<p class="courseblocktitle"><strong>{}</strong></p>\n'
+                '<p class="courseblockdesc">\n{}</p>\n'
+                '<p class="courseblockdetail">Terms Offered: Autumn</p>\n'
+                '</div>').format(p, title, description)
+
+    def index_page(self):
+        '''
+        Return the HTML of the index page.
+        '''
+        links = "\n".join('<li><a href="thecollege/dept-{}/">Department {}</a></li>'
+                          .format(d, d) for d in range(self.num_depts))
+        return ("<html><head><title>College Catalog</title></head><body>\n"
+                "<ul>\n{}\n</ul>\n</body></html>\n").format(links)
+
+    def dept_page(self, d):
+        '''
+        Return the HTML of department page d.
+        '''
+        rnd = random.Random(self.seed * 1000003 + d)
+        course = d * self.courses_per_page * 2
+        blocks = []
+        for _ in range(rnd.randint(0, 2 * self.courses_per_page)):
+            description = self._words(rnd, rnd.randint(10, 80)) + "."
+            kind = rnd.random()
+            if kind < 0.15:
+                # sequence: the subsequence blocks directly follow the main block
+                first, last = self._code(course), self._code(course + 2)
+                title = "{}-{}. {} Sequence.".format(first, last[5:], self._words(rnd, 2).title())
+                subs = []
+                for _ in range(3):
+                    sub_title = "{}. {}.".format(self._code(course), self._words(rnd, 3).title())
+                    subs.append(self._block("subsequence", sub_title,
+                                            self._words(rnd, rnd.randint(5, 30)) + "."))
+                    course += 1
+                blocks.append(self._block("main", title, description) + "".join(subs))
+            elif kind < 0.3:
+                title = "{}/{}. {}.".format(self._code(course), self._code(course + 1),
+                                            self._words(rnd, 3).title())
+                blocks.append(self._block("main", title, description))
+                course += 2
+            else:
+                title = "{}. {}.".format(self._code(course), self._words(rnd, 3).title())
+                blocks.append(self._block("main", title, description))
+                course += 1
+
+        links = ['<a href="../../index.html">Catalog</a>']
+        for _ in range(rnd.randint(0, 2 * self.fan_out)):
+            links.append('<a href="../dept-{}/">Related</a>'.format(
+                rnd.randrange(max(self.num_depts, 1))))
+        links.append('<a href="http://www.example.com/elsewhere.html">Elsewhere</a>')
+        links.append('<a href="mailto:catalog@example.com">Mail</a>')
+        links.append('<a href="#top">Top</a>')
+        links.append('<a href="../dept-{}/missing.html">Missing</a>'.format(d))
+        return ("<html><head><title>Department {}</title></head><body>\n"
+                '<div class="sc_sccoursedescs">\n{}\n</div>\n{}\n'
+                "</body></html>\n").format(d, "\n".join(blocks), "\n".join(links))
+
+    def undeclared_charset(self, path):
+        '''
+        Return whether the page at path is served without a charset.
+        '''
+        d = path.rstrip("/").rpartition("dept-")[2]
+        return d.isdigit() and int(d) % 2 == 1
+
+    def page(self, path):
+        '''
+        Return the HTML of the page at path, or None.
+        '''
+        if path == INDEX_PATH:
+            return self.index_page()
+        prefix, suffix = DEPT_PATH.split("{}")
+        if path.startswith(prefix) and path.endswith(suffix):
+            d = path[len(prefix):-len(suffix)]
+            if d.isdigit() and int(d) < self.num_depts:
+                return self.dept_page(int(d))
+        return None
+
+
+def make_handler(catalog, latency=0.0, error_rate=0.0):
+    '''
+    Make a request handler class that serves catalog, waiting latency
+    seconds per request and failing error_rate of the requests with 500.
+    '''
+    error_rnd = random.Random(catalog.seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately: do not let Nagle's
+        # algorithm hold the body back
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, status, body=b"", headers=()):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            with lock:
+                fail = error_rate and error_rnd.random() < error_rate
+            if fail:
+                self.send(500)
+                return
+            html = catalog.page(self.path)
+            if html is None:
+                self.send(404)
+                return
+            body = html.encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                self.send(304, headers=[("ETag", etag)])
+                return
+            content_type = "text/html"
+            if not catalog.undeclared_charset(self.path):
+                content_type += "; charset=utf-8"
+            self.send(200, body, [("Content-Type", content_type), ("ETag", etag)])
+
+    return Handler
+
+
+def start_server(course_map_filename="course_map.json", port=0, num_pages=1000,
+                 seed=0, latency=0.0, error_rate=0.0):
+    '''
+    Start a catalog server in a background thread.
+
+    Returns:
+        (server, starting_url, limiting_domain) triple.  Call
+        server.shutdown() to stop the server.
+    '''
+    with open(course_map_filename) as f:
+        course_map = json.load(f)
+    catalog = SyntheticCatalog(course_map, num_pages, seed)
+    server = ThreadingHTTPServer(("127.0.0.1", port),
+                                 make_handler(catalog, latency, error_rate))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    limiting_domain = "{}:{}".format(host, port)
+    return server, "http://" + limiting_domain + INDEX_PATH, limiting_domain
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, starting_url, limiting_domain = start_server(
+        port=args.port, num_pages=args.pages, seed=args.seed,
+        latency=args.latency, error_rate=args.error_rate)
+    print(starting_url, limiting_domain, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
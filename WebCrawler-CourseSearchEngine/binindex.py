@@ -0,0 +1,182 @@
+"""
+Compact binary format for the word -> course ids index.
+
+Layout (little-endian):
+    header: magic b"CIX1", format version (u32), number of terms n (u32)
+    term offsets: n + 1 u32, offsets of the terms in the term blob
+    postings offsets: n + 1 u64, offsets of the postings in the postings blob
+    term blob: the UTF-8 terms, sorted, concatenated
+    postings blob: for each term, its sorted course ids, delta-encoded
+      as unsigned LEB128 varints
+
+A lookup binary-searches the term offsets and slices the postings out of
+the memory-mapped file, without loading the whole index.
+"""
+# pylint: disable-msg=invalid-name
+
+import mmap
+import struct
+
+MAGIC = b"CIX1"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+TERM_OFFSET = struct.Struct("<I")
+POSTINGS_OFFSET = struct.Struct("<Q")
+
+
+def encode_postings(course_ids):
+    '''
+    Delta-encode a sorted list of course ids as varints.
+    '''
+    out = bytearray()
+    prev = 0
+    for course_id in course_ids:
+        delta = course_id - prev
+        prev = course_id
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def decode_postings(data):
+    '''
+    Decode delta-encoded varints back into the list of course ids.
+    '''
+    course_ids = []
+    prev = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        prev += value
+        course_ids.append(prev)
+        value = 0
+        shift = 0
+    return course_ids
+
+
+def write_index(index, filename):
+    '''
+    Write the index (word -> course ids) in the binary format.
+    '''
+    terms = sorted(index, key=lambda word: word.encode("utf-8"))
+    term_blob = bytearray()
+    postings_blob = bytearray()
+    term_offsets = [0]
+    postings_offsets = [0]
+    for term in terms:
+        term_blob += term.encode("utf-8")
+        postings_blob += encode_postings(sorted(index[term]))
+        term_offsets.append(len(term_blob))
+        postings_offsets.append(len(postings_blob))
+
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(terms)))
+        for offset in term_offsets:
+            f.write(TERM_OFFSET.pack(offset))
+        for offset in postings_offsets:
+            f.write(POSTINGS_OFFSET.pack(offset))
+        f.write(term_blob)
+        f.write(postings_blob)
+
+
+class IndexReader:
+    '''
+    Memory-mapped reader of an index in the binary format.
+    '''
+
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap cannot map an empty file
+            self.file.close()
+            raise ValueError("{} is not a binary index".format(filename))
+        self.buf = memoryview(self.mm)
+        magic, version, self.num_terms = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("{} is not a binary index".format(filename))
+        n = self.num_terms
+        self.term_offsets_pos = HEADER.size
+        self.postings_offsets_pos = self.term_offsets_pos + TERM_OFFSET.size * (n + 1)
+        self.terms_pos = self.postings_offsets_pos + POSTINGS_OFFSET.size * (n + 1)
+        self.postings_pos = self.terms_pos + self._term_offset(n)
+
+    def _term_offset(self, i):
+        return TERM_OFFSET.unpack_from(
+            self.buf, self.term_offsets_pos + TERM_OFFSET.size * i)[0]
+
+    def _postings_offset(self, i):
+        return POSTINGS_OFFSET.unpack_from(
+            self.buf, self.postings_offsets_pos + POSTINGS_OFFSET.size * i)[0]
+
+    def _term(self, i):
+        start = self.terms_pos + self._term_offset(i)
+        end = self.terms_pos + self._term_offset(i + 1)
+        return self.mm[start:end]
+
+    def _find(self, term):
+        key = term.encode("utf-8")
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_terms and self._term(lo) == key:
+            return lo
+        return None
+
+    def __len__(self):
+        return self.num_terms
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+    def terms(self):
+        '''
+        Yield the terms of the index, in sorted order.
+        '''
+        for i in range(self.num_terms):
+            yield self._term(i).decode("utf-8")
+
+    def raw_postings(self, term):
+        '''
+        Return a memoryview of the encoded postings of term (empty if the
+        term is not in the index), without copying them.
+        '''
+        i = self._find(term)
+        if i is None:
+            return self.buf[0:0]
+        start = self.postings_pos + self._postings_offset(i)
+        end = self.postings_pos + self._postings_offset(i + 1)
+        return self.buf[start:end]
+
+    def postings(self, term):
+        '''
+        Return the sorted list of course ids of term.
+        '''
+        return decode_postings(self.raw_postings(term))
+
+    def close(self):
+        '''
+        Unmap and close the file.  Memoryviews returned by raw_postings
+        must be released first.
+        '''
+        self.buf.release()
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,137 @@
+"""
+Checkpoints of a running crawl, to resume it after it stops.
+"""
+# pylint: disable-msg=invalid-name
+
+import os
+import json
+
+VERSION = 1
+CHECKPOINT_EVERY = 50
+
+
+class Checkpoint:
+    '''
+    Append-only journal of the pages a crawl has processed, in crawl
+    order.  The frontier, the visited URLs and the index of the crawl are
+    all determined by this sequence, so a crawl can be resumed by
+    replaying the journal instead of fetching and parsing the pages again.
+
+    Layout of the file (one JSON record per line):
+        header: {"version", "starting_url", "config", "positions"}, where
+          config is a digest of the course map and stop words (see
+          incremental.digest_config) and positions tells whether the
+          crawl records the positions of words
+        one record per URL taken off the queue and fetched:
+          {"url", "digest", "links", "postings"[, "positions"]} for a
+          processed page, or {"url", "failed": true} for a failed request
+
+    Records are buffered and appended every `every` pages, so a
+    checkpoint costs one write of the pages since the last one, not a
+    rewrite of the whole crawl state.  A torn last line, left by a crawl
+    that died while writing, is discarded on resume.
+    '''
+
+    def __init__(self, filename, starting_url, config_digest, resume=False,
+                 every=CHECKPOINT_EVERY, positions=False):
+        self.filename = filename
+        self.every = every
+        self.header = {"version": VERSION, "starting_url": starting_url,
+                       "config": config_digest, "positions": positions}
+        self.records = []
+        self.pending = []
+        if resume and os.path.exists(filename):
+            self._load()
+            self.file = open(filename, "a")
+        else:
+            self.file = open(filename, "w")
+            self._write([self.header])
+
+    def _load(self):
+        with open(self.filename, "rb") as f:
+            lines = f.read().split(b"\n")
+        good_size = 0
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            records.append(record)
+            good_size += len(line) + 1
+        if not records or records[0] != self.header:
+            raise ValueError("{} is not a checkpoint of this crawl".format(self.filename))
+        # Drop a torn last record
+        with open(self.filename, "r+b") as f:
+            f.truncate(good_size)
+        self.records = records[1:]
+
+    def _write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def __iter__(self):
+        '''
+        Iterate over the records loaded from an earlier run.
+        '''
+        return iter(self.records)
+
+    def _append(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.every:
+            self.flush()
+
+    def record_page(self, url, digest, links, postings, positions=None):
+        '''
+        Record a processed page.
+
+        Inputs:
+            url: URL of the page
+            digest: digest of the page contents, or None
+            links: list of the URLs the page links to that may be followed
+            postings: dict of word -> set of course ids from the page
+            positions: optional positions of the words of the page's
+              courses (see crawler.index_course_blocks)
+        '''
+        record = {"url": url, "digest": digest, "links": links,
+                  "postings": {word: sorted(ids) for word, ids in postings.items()}}
+        if positions is not None:
+            record["positions"] = positions
+        self._append(record)
+
+    def record_failed(self, url):
+        '''
+        Record a URL whose request failed.
+        '''
+        self._append({"url": url, "failed": True})
+
+    def flush(self):
+        '''
+        Append the pending records to the file.
+        '''
+        if self.pending:
+            self._write(self.pending)
+            self.pending = []
+
+    def close(self):
+        '''
+        Append the pending records and close the file.
+        '''
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Keep the pages processed before an error or an interrupt
+        self.flush()
+
+    def remove(self):
+        '''
+        Close and delete the checkpoint of a finished crawl.
+        '''
+        self.file.close()
+        os.remove(self.filename)
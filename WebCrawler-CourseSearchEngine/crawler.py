@@ -6,13 +6,31 @@ Yixin Ding, Jiaming (Vera) Mao
 # pylint: disable-msg=invalid-name, redefined-outer-name, unused-argument, unused-variable
 
 import queue
+import os
 import json
 import sys
 import csv
 import re
-from bs4 import BeautifulSoup
-import util
-from collections import deque
+import argparse
+import functools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import parsing
+import fetch
+import pagestore
+import incremental
+import binindex
+import dbload
+import positional
+import checkpoint
+import scheduler
+from extsort import SpillingIndex
+from frontier import Frontier
+from metrics import CrawlMetrics
+from analyzer import Analyzer, load_stop_words
+
+STARTING_URL = "http://www.classes.cs.uchicago.edu/archive/2015/winter/12200-1/new.collegecatalog.uchicago.edu/index.html"
+LIMITING_DOMAIN = "classes.cs.uchicago.edu"
 
 INDEX_IGNORE = set(['a', 'also', 'an', 'and', 'are', 'as', 'at', 'be',
                     'but', 'by', 'course', 'for', 'from', 'how', 'i',
@@ -23,6 +41,12 @@ INDEX_IGNORE = set(['a', 'also', 'an', 'and', 'are', 'as', 'at', 'be',
                     'yet']) 
 
 
+DEFAULT_ANALYZER = Analyzer(INDEX_IGNORE)
+
+# Seconds to wait for the host before retrying a request (adaptive crawls)
+FETCH_TIMEOUT = 30
+
+
 def extract_words(text):
     '''
     Extract valid words from the given text.
@@ -33,19 +57,7 @@ def extract_words(text):
     Returns:
         List of valid words (lowercase, without stop words).
     '''
-    # First convert text to lowercase
-    text = text.lower()
-    
-    # Use regex to find words (letters followed by letters, numbers, or underscores)
-    words = re.findall(r'\b([a-zA-Z][\w\-]*)\b', text)
-    
-    # Filter out stop words and ensure unique words
-    valid_words = []
-    for word in words:
-        if word not in INDEX_IGNORE and word not in valid_words:
-            valid_words.append(word)
-    
-    return valid_words
+    return DEFAULT_ANALYZER.extract_words(text)
 
 def extract_course_code(text):
     '''
@@ -74,75 +86,200 @@ def write_to_csv(index, filename):
             for course_id in sorted(course_ids):
                 writer.writerow([course_id, word])
 
-def process_course_page(soup, course_map, index):
+def count_course(metrics, course_code, course_map):
     '''
-    Extract course data from a page and update the index.
+    Count a course code found in a page as matched or unmatched against
+    the course map.
     '''
-    for course_block in soup.find_all('div', class_="courseblock main"):
-        title_tag = course_block.find('p', class_="courseblocktitle")
-        desc_tag = course_block.find('p', class_="courseblockdesc")
-        
-        if title_tag:
-            title = title_tag.text.strip()
+    if metrics is not None and course_code:
+        if course_code in course_map:
+            metrics.incr("courses_matched")
         else:
-            continue
-            
-        if desc_tag:
-            description = desc_tag.text.strip()
-        else:
-            description = ""
-
-        # Process any sequence courses first
-        subsequences = util.find_sequence(course_block)
-        if subsequences:
-            # Get the main sequence description which applies to all courses in sequence
-            sequence_desc = description
-
-            for subsequence in subsequences:
-                sub_title = subsequence.find('p', class_="courseblocktitle").text.strip()
-                sub_desc = subsequence.find('p', class_="courseblockdesc")
-                
-                # Combine sequence description with individual description if it exists
-                if sub_desc:
-                    full_desc = sequence_desc + " " + sub_desc.text.strip()
-                else:
-                    full_desc = sequence_desc
-                
-                sub_course_code = extract_course_code(sub_title)
-                if sub_course_code and sub_course_code in course_map:
-                    sub_course_id = course_map[sub_course_code]
-                    sub_words = extract_words(sub_title + " " + full_desc)
-                    for word in sub_words:
-                        if word not in index:
-                            index[word] = set()
-                        index[word].add(sub_course_id)
-
-        # Get the primary course code
-        course_code = extract_course_code(title)
-        if course_code and course_code in course_map:
-            course_id = course_map[course_code]
-            # Extract words from title and description
-            words = extract_words(title + " " + description)
-            # Add words to index
-            for word in words:
-                if word not in index:
-                    index[word] = set()
-                index[word].add(course_id)
-        
-        # Process cross-listed courses if present
+            metrics.incr("courses_unmatched")
+
+def add_postings(index, words, course_ids):
+    '''
+    Add every course id in course_ids to the postings of every word.
+    '''
+    for word in words:
+        postings = index.get(word)
+        if postings is None:
+            index[word] = postings = set()
+        postings.update(course_ids)
+
+def index_course_blocks(course_blocks, course_map, index, metrics=None,
+                        analyzer=None, positions=None):
+    '''
+    Add the words of a page's course blocks (see parsing.CourseBlock) to
+    the index.  Course blocks and course codes are counted in metrics, if
+    given.
+
+    The title and description of a block are tokenized once, by analyzer
+    (the INDEX_IGNORE analyzer by default), and shared by the courses of
+    its sequence and its cross-listed courses.
+
+    If positions is a list, a [course_id, term -> positions, length]
+    entry with the positions of the words of the course's text (see
+    positional.course_document) is also appended to it for every course
+    indexed.
+    '''
+    if analyzer is None:
+        analyzer = DEFAULT_ANALYZER
+
+    def tokenize(text):
+        # With positions, the terms are the keys of the positions, in
+        # order of first occurrence, so every text is tokenized once
+        if positions is None:
+            return analyzer.terms(text), None
+        field = analyzer.positions(text)
+        return list(field[0]), field
+
+    for title, description, subsequences in course_blocks:
+        if metrics is not None:
+            metrics.incr("course_blocks")
+        title_terms, title_field = tokenize(title)
+        desc_terms, desc_field = tokenize(description)
+
+        # Process any sequence courses first.  The main sequence
+        # description applies to all courses in the sequence, combined
+        # with the individual description if it exists.
+        for sub_title, sub_desc in subsequences:
+            sub_course_code = extract_course_code(sub_title)
+            count_course(metrics, sub_course_code, course_map)
+            if sub_course_code and sub_course_code in course_map:
+                sub_course_id = course_map[sub_course_code]
+                sub_title_terms, sub_title_field = tokenize(sub_title)
+                fields = [sub_title_field, desc_field]
+                sub_desc_terms = []
+                if sub_desc is not None:
+                    sub_desc_terms, sub_desc_field = tokenize(sub_desc)
+                    fields.append(sub_desc_field)
+                sub_words = analyzer.unique(sub_title_terms, desc_terms, sub_desc_terms)
+                add_postings(index, sub_words, [sub_course_id])
+                if positions is not None:
+                    positions.append([sub_course_id, *positional.course_document(fields)])
+
+        # The primary course and any cross-listed courses share the
+        # words of the title and description
+        course_ids = []
+        codes = [extract_course_code(title)]
         cross_listed = title.split('/')
-        if len(cross_listed) > 1:
-            for cross_code in cross_listed[1:]:
-                course_code = extract_course_code(cross_code)
-                if course_code and course_code in course_map:
-                    course_id = course_map[course_code]
-                    words = extract_words(title + " " + description)
-                    for word in words:
-                        if word not in index:
-                            index[word] = set()
-                        index[word].add(course_id)
-
-def go(num_pages_to_crawl, course_map_filename, index_filename):
+        for cross_code in cross_listed[1:]:
+            codes.append(extract_course_code(cross_code))
+        for course_code in codes:
+            count_course(metrics, course_code, course_map)
+            if course_code and course_code in course_map:
+                course_ids.append(course_map[course_code])
+        if course_ids:
+            add_postings(index, analyzer.unique(title_terms, desc_terms), course_ids)
+            if positions is not None:
+                document = positional.course_document([title_field, desc_field])
+                for course_id in course_ids:
+                    positions.append([course_id, *document])
+
+def process_course_page(soup, course_map, index, metrics=None):
+    '''
+    Extract course data from a page and update the index.  Course blocks
+    and course codes are counted in metrics, if given.
+    '''
+    index_course_blocks(parsing.soup_course_blocks(soup), course_map, index, metrics)
+
+def index_page(html, course_map, analyzer, parser, metrics, positions=False):
+    '''
+    Parse a page and index its course blocks into a partial index.
+
+    Returns:
+        (hrefs, page_index, page_positions) triple: the hrefs of the
+        page's links, the partial index (word -> set of course ids) of
+        the page and, if positions is True, the positions of the words of
+        its courses (see index_course_blocks), or None
+    '''
+    with metrics.timer("parse"):
+        page = parsing.parse_page(html, parser)
+        course_blocks = page.course_blocks()
+        hrefs = page.links()
+    page_index = {}
+    page_positions = [] if positions else None
+    with metrics.timer("index"):
+        index_course_blocks(course_blocks, course_map, page_index, metrics, analyzer,
+                            page_positions)
+    return hrefs, page_index, page_positions
+
+# Configuration of an index worker process, set by init_index_worker
+_index_worker = {}
+
+def init_index_worker(course_map, stop_words, parser, positions=False):
+    '''
+    Set up an index worker process.
+    '''
+    _index_worker["course_map"] = course_map
+    _index_worker["analyzer"] = Analyzer(stop_words)
+    _index_worker["parser"] = parser
+    _index_worker["positions"] = positions
+
+def index_page_worker(html):
+    '''
+    index_page in an index worker process.
+
+    Returns:
+        (hrefs, page_index, page_positions, counters, timers), where
+        counters and timers are the worker's metrics for the page
+    '''
+    metrics = CrawlMetrics()
+    hrefs, page_index, page_positions = index_page(
+        html, _index_worker["course_map"], _index_worker["analyzer"],
+        _index_worker["parser"], metrics, _index_worker["positions"])
+    return hrefs, page_index, page_positions, metrics.counters, metrics.timers
+
+def merge_index(index, page_index):
+    '''
+    Add the postings of page_index (word -> course ids) to index.
+    '''
+    for word, course_ids in page_index.items():
+        if word not in index:
+            index[word] = set()
+        index[word].update(course_ids)
+
+def replay_checkpoint(records, frontier, merge, state=None):
+    '''
+    Bring a new crawl to the point where the crawl that wrote a
+    checkpoint stopped, by replaying its records (see checkpoint.py):
+    the frontier, the index (through merge(postings, positions)) and the
+    incremental state, if given, are updated as they were when the pages
+    were processed.
+
+    Returns:
+        the number of pages replayed
+    '''
+    pages_replayed = 0
+    for record in records:
+        current_url = None
+        while frontier and (current_url is None or frontier.is_visited(current_url)):
+            current_url = frontier.pop()
+        if current_url != record["url"]:
+            raise ValueError("checkpoint does not match the crawl at {}"
+                             .format(record["url"]))
+        if record.get("failed"):
+            continue
+        merge(record["postings"], record.get("positions"))
+        if state is not None and record["digest"] is not None:
+            state.record(current_url, record["digest"], record["links"],
+                         record["postings"], record.get("positions"))
+        for full_url in record["links"]:
+            frontier.push(full_url)
+        frontier.mark_visited(current_url)
+        pages_replayed += 1
+    return pages_replayed
+
+def go(num_pages_to_crawl, course_map_filename, index_filename, num_workers=1,
+       cache_dir=None, archive_dir=None, replay=False, state_filename=None,
+       bloom_capacity=None, metrics_callback=None, report_filename=None,
+       parser=parsing.DEFAULT_PARSER, stop_words=None, index_workers=1,
+       binary_index_filename=None, max_postings=None, db_filename=None,
+       starting_url=STARTING_URL, limiting_domain=LIMITING_DOMAIN,
+       checkpoint_filename=None, resume=False,
+       checkpoint_every=checkpoint.CHECKPOINT_EVERY, adaptive=False,
+       max_retries=scheduler.MAX_RETRIES, max_rate=None, positions=False):
     '''
     Crawl the college catalog and generates a CSV file with an index.
 
@@ -151,83 +288,314 @@ def go(num_pages_to_crawl, course_map_filename, index_filename):
         course_map_filename: the name of a JSON file that contains the mapping
           course codes to course identifiers
         index_filename: the name for the CSV of the index.
+        num_workers: the maximum number of requests in flight.  Pages are
+          still processed in crawl order, so the index is the same as
+          a serial crawl's.
+        cache_dir: optional directory for the HTTP cache.  Pages are
+          requested conditionally on the validators recorded by earlier
+          crawls, and pages that have not changed are read from the cache.
+        archive_dir: optional directory of a PageStore.  Every page fetched
+          is recorded in it.
+        replay: if True, read the pages from archive_dir instead of the
+          network.  Pages missing from the archive are treated as failed
+          requests.
+        state_filename: optional JSON file with the state of the last
+          crawl.  Only the pages that changed since then are parsed and
+          indexed; the others reuse the links and postings recorded for
+          them.  The changes to the index are also written to
+          <index_filename without .csv>-delta.csv.
+        bloom_capacity: if given, keep the visited URLs in a Bloom filter
+          sized for this many URLs instead of a set (see Frontier).
+        metrics_callback: optional function called as
+          metrics_callback(url, metrics) after each page is processed,
+          with the CrawlMetrics of the crawl.
+        report_filename: optional name for a JSON report of the metrics.
+        parser: name of the HTML parsing backend (see parsing.PARSERS).
+          "lxml-fast" extracts only the course blocks and links, without
+          building a BeautifulSoup tree.
+        stop_words: words left out of the index (INDEX_IGNORE by default)
+        index_workers: if more than 1, the number of processes that parse
+          and index pages.  Each page is indexed into a partial index as
+          soon as it is fetched, and the partial indexes are merged in
+          crawl order, so the index is the same as a serial crawl's.
+        binary_index_filename: optional name for a copy of the index in
+          the compact binary format of binindex.py.
+        max_postings: if given, keep at most this many postings in memory
+          and spill the rest to sorted runs on disk (see SpillingIndex).
+          Cannot be combined with state_filename or binary_index_filename,
+          which need the whole index in memory.
+        db_filename: optional SQLite course database whose catalog_index
+          table is replaced with the index (see dbload.load_catalog).
+        starting_url, limiting_domain: where the crawl starts and the
+          domain it stays in (the college catalog by default)
+        checkpoint_filename: optional file to checkpoint the crawl to
+          every checkpoint_every pages (see checkpoint.Checkpoint).  The
+          file is deleted when the crawl finishes.
+        resume: if True, resume the crawl checkpointed to
+          checkpoint_filename instead of starting over.  The pages it
+          processed are not fetched again, and the index is the same as
+          an uninterrupted crawl's.
+        adaptive: if True, adapt the number of requests in flight to the
+          host (up to num_workers) to its latency and errors, and retry
+          requests that fail with connection errors, timeouts or 429/5xx
+          responses up to max_retries times, with backoff (see
+          scheduler.AdaptiveScheduler).  Pages that still fail are listed
+          in the failures of the metrics report.
+        max_rate: optional maximum number of requests per second to the
+          host (adaptive only)
+        positions: if True, also record the positions of the words in
+          the text of every course, and load them into the
+          catalog_positions table of db_filename for phrase queries,
+          with the BM25 statistics of ranked queries (see
+          dbload.load_catalog).  Needs db_filename.
+
+    Returns:
+        the CrawlMetrics of the crawl
 
     Outputs:
         CSV file of the index.
     '''
-    starting_url = "http://www.classes.cs.uchicago.edu/archive/2015/winter/12200-1/new.collegecatalog.uchicago.edu/index.html"
-    limiting_domain = "classes.cs.uchicago.edu"
-
     # Read course map
     with open(course_map_filename, 'r') as f:
         course_map = json.load(f)
 
+    if stop_words is None:
+        stop_words = INDEX_IGNORE
+    analyzer = Analyzer(stop_words)
+
+    if max_postings and (state_filename or binary_index_filename):
+        raise ValueError("max_postings cannot be combined with state_filename "
+                         "or binary_index_filename")
+    if positions and not db_filename:
+        raise ValueError("positions needs a db_filename")
+
     # Initialize crawling data structures
-    urls_to_visit = deque([starting_url])
-    already_visited = set()
-    index = {}  # word -> set of course identifiers
-    
-    pages_processed = 0
-    total_courses_found = 0
-    matched_courses = 0
-
-    while urls_to_visit and pages_processed < num_pages_to_crawl:
-        current_url = urls_to_visit.popleft()
-        
-        # Skip if already visited
-        if current_url in already_visited:
-            continue
-        
-        # Get and parse the page
-        request = util.get_request(current_url)
-        if not request:
-            continue
-            
-        html = util.read_request(request)
-        soup = BeautifulSoup(html, "html5lib")
-
-        # Count courses before processing
-        courses_before = sum(len(ids) for ids in index.values() if isinstance(ids, set))
-        
-        # Process the page
-        process_course_page(soup, course_map, index)
-        
-        # Count courses after processing
-        courses_after = sum(len(ids) for ids in index.values() if isinstance(ids, set))
-        new_courses = courses_after - courses_before
-        total_courses_found += len(soup.find_all('div', class_="courseblock main"))
-        matched_courses += new_courses
-
-        # Queue additional URLs
-        for link in soup.find_all('a', href=True):
-            href = link['href']
-            full_url = util.convert_if_relative_url(current_url, href)
-            if full_url and util.is_url_ok_to_follow(full_url, limiting_domain):
-                if full_url not in already_visited and full_url not in urls_to_visit:
-                    urls_to_visit.append(full_url)
-
-        # Mark page as visited and update counter
-        already_visited.add(current_url)
-        pages_processed += 1
-    
-    # Write the final index to CSV
-    write_to_csv(index, index_filename)
+    frontier = Frontier([starting_url], limiting_domain, bloom_capacity)
+    if max_postings:
+        index = SpillingIndex(max_postings)
+    else:
+        index = {}  # word -> set of course identifiers
+    positional_index = positional.PositionalIndex() if positions else None
+    try:
+        def merge_page(page_index, page_positions):
+            if max_postings:
+                index.merge(page_index)
+            else:
+                merge_index(index, page_index)
+            if positional_index is not None:
+                positional_index.merge(page_positions)
+
+        pages_processed = 0
+        metrics = CrawlMetrics(metrics_callback)
+
+        session = fetch.make_session(max(num_workers, 1))
+        cache = fetch.HttpCache(cache_dir) if cache_dir else None
+        archive = pagestore.PageStore(archive_dir) if archive_dir else None
+        if replay:
+            if archive is None:
+                raise ValueError("replay needs an archive_dir")
+            fetch_page = archive.fetch_page
+        else:
+            fetch_page = functools.partial(fetch.fetch_page, session=session, cache=cache)
+            if adaptive:
+                host_scheduler = scheduler.AdaptiveScheduler(
+                    num_workers, max_retries=max_retries, max_rate=max_rate, metrics=metrics)
+                fetch_page = host_scheduler.scheduled(
+                    functools.partial(fetch.fetch_page, session=session, cache=cache,
+                                      timeout=FETCH_TIMEOUT, raise_transient=True))
+            if archive is not None:
+                fetch_page = archive.recording(fetch_page)
+        fetch_page = metrics.timed_fetch(fetch_page)
+
+        state = None
+        if state_filename:
+            state = incremental.CrawlState(state_filename, course_map, stop_words)
+
+        if resume and not checkpoint_filename:
+            raise ValueError("resume needs a checkpoint_filename")
+        journal = None
+        if checkpoint_filename:
+            journal = checkpoint.Checkpoint(
+                checkpoint_filename, starting_url,
+                incremental.digest_config(course_map, stop_words), resume,
+                checkpoint_every, positions)
+            pages_processed = replay_checkpoint(journal, frontier, merge_page, state)
+            metrics.incr("pages_resumed", pages_processed)
+
+        index_pool = None
+        num_fetchers = num_workers
+        if index_workers > 1:
+            index_pool = ProcessPoolExecutor(index_workers, initializer=init_index_worker,
+                                             initargs=(course_map, stop_words, parser,
+                                                       positions))
+            # Keep enough pages in the pipeline for every index worker, with
+            # no more than num_workers requests in flight
+            num_fetchers = max(num_workers, index_workers)
+            fetch_page = fetch.limit_in_flight(fetch_page, max(num_workers, 1))
+
+        def fetch_and_index(url):
+            request, html = fetch_page(url)
+            parsed = None
+            if request and index_pool is not None:
+                if state is None or not state.is_unchanged(url, incremental.digest_page(html),
+                                                           positions):
+                    parsed = index_pool.submit(index_page_worker, html).result()
+            return request, html, parsed
+
+        # The index workers shut down when the crawl ends, even on an error,
+        # after the prefetcher's threads stop submitting pages to them
+        with session, index_pool or contextlib.nullcontext(), \
+             fetch.Prefetcher(num_fetchers, fetch_and_index) as prefetcher, \
+             journal or contextlib.nullcontext():
+            while frontier and pages_processed < num_pages_to_crawl:
+                prefetcher.fill(frontier, frontier.visited)
+                current_url = frontier.pop()
+
+                # Skip if already visited
+                if frontier.is_visited(current_url):
+                    continue
+
+                # Get the page
+                request, html, parsed = prefetcher.get(current_url)
+                if not request:
+                    if journal is not None:
+                        journal.record_failed(current_url)
+                    continue
+
+                # Reuse what the last crawl learned from an unchanged page
+                reused = None
+                digest = None
+                if state is not None:
+                    digest = incremental.digest_page(html)
+                    reused = state.lookup(current_url, digest, positions)
+
+                if reused is not None:
+                    links, page_index, page_positions = reused
+                    metrics.incr("pages_reused")
+                else:
+                    # Process the page, unless an index worker already has
+                    if parsed is None:
+                        hrefs, page_index, page_positions = index_page(
+                            html, course_map, analyzer, parser, metrics, positions)
+                    else:
+                        hrefs, page_index, page_positions, counters, timers = parsed
+                        metrics.merge(counters, timers)
+
+                    with metrics.timer("links"):
+                        links = frontier.find_links(hrefs, current_url)
+                    if state is not None:
+                        state.record(current_url, digest, links, page_index, page_positions)
+                merge_page(page_index, page_positions)
+
+                if journal is not None:
+                    journal.record_page(current_url, digest, links, page_index, page_positions)
+
+                # Queue additional URLs
+                for full_url in links:
+                    frontier.push(full_url)
+
+                # Mark page as visited and update counter
+                frontier.mark_visited(current_url)
+                pages_processed += 1
+                metrics.page_done(current_url)
+
+        if cache is not None:
+            cache.save()
+
+        if state is not None:
+            added, removed = state.delta(index)
+            delta_filename = os.path.splitext(index_filename)[0] + "-delta.csv"
+            incremental.write_delta(added, removed, delta_filename)
+            state.save()
+
+        # Write the final index to CSV
+        if max_postings:
+            index.write_csv(index_filename)
+            rows = ((course_id, word) for word, course_id in index.items())
+        else:
+            write_to_csv(index, index_filename)
+            rows = dbload.index_rows(index)
+        if db_filename:
+            # The postings, positions and scores are swapped in together
+            dbload.load_catalog(rows, db_filename, positional_index, stop_words)
+        if binary_index_filename:
+            binindex.write_index(index, binary_index_filename)
+    finally:
+        # Delete the spilled runs, even if the crawl raised
+        if max_postings:
+            index.close()
+
+    if journal is not None:
+        journal.remove()
+
+    for url, reason in sorted(metrics.failures.items()):
+        print("fetch failed: {} ({})".format(url, reason), file=sys.stderr)
+
+    metrics.finish()
+    if report_filename:
+        metrics.write_report(report_filename)
+    return metrics
 
 if __name__ == "__main__":
-    usage = "python3 crawl.py <number of pages to crawl>"
-    args_len = len(sys.argv)
+    parser = argparse.ArgumentParser(usage="python3 crawl.py <number of pages to crawl>")
+    parser.add_argument("num_pages_to_crawl", type=int, nargs="?", default=1000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="maximum number of requests in flight")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory for the conditional-request HTTP cache")
+    parser.add_argument("--archive-dir", default=None,
+                        help="directory of the archive every fetched page is saved to")
+    parser.add_argument("--replay", action="store_true",
+                        help="crawl the pages saved in --archive-dir instead of the network")
+    parser.add_argument("--state", default=None,
+                        help="state file of the last crawl, to only reindex changed pages")
+    parser.add_argument("--bloom-capacity", type=int, default=None,
+                        help="keep visited URLs in a Bloom filter sized for this many URLs")
+    parser.add_argument("--report", default=None,
+                        help="write a JSON report of the crawl metrics to this file")
+    parser.add_argument("--parser", default=parsing.DEFAULT_PARSER,
+                        choices=sorted(parsing.PARSERS),
+                        help="HTML parsing backend")
+    parser.add_argument("--stop-words", default=None,
+                        help="file of stop words to ignore in addition to INDEX_IGNORE")
+    parser.add_argument("--index-workers", type=int, default=1,
+                        help="number of processes that parse and index pages")
+    parser.add_argument("--binary-index", default=None,
+                        help="also write the index in the compact binary format to this file")
+    parser.add_argument("--max-postings", type=int, default=None,
+                        help="spill the index to disk beyond this many postings in memory")
+    parser.add_argument("--db", default=None,
+                        help="SQLite course database to load the index into")
+    parser.add_argument("--checkpoint", default=None,
+                        help="file to checkpoint the crawl to, to resume it if it stops")
+    parser.add_argument("--checkpoint-every", type=int, default=checkpoint.CHECKPOINT_EVERY,
+                        help="number of pages between checkpoints")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume the crawl checkpointed to --checkpoint")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adapt the requests in flight (up to --workers) to the host, "
+                             "and retry failed requests")
+    parser.add_argument("--max-retries", type=int, default=scheduler.MAX_RETRIES,
+                        help="retries of a failed request (--adaptive)")
+    parser.add_argument("--max-rate", type=float, default=None,
+                        help="maximum requests per second to the host (--adaptive)")
+    parser.add_argument("--positions", action="store_true",
+                        help="also load the positions of words into --db, for phrase queries")
+    args = parser.parse_args()
     course_map_filename = "course_map.json"
     index_filename = "catalog_index.csv"
-    if args_len == 1:
-        num_pages_to_crawl = 1000
-    elif args_len == 2:
-        try:
-            num_pages_to_crawl = int(sys.argv[1])
-        except ValueError:
-            print(usage)
-            sys.exit(0)
-    else:
-        print(usage)
-        sys.exit(0)
+    stop_words = None
+    if args.stop_words:
+        stop_words = INDEX_IGNORE | load_stop_words(args.stop_words)
 
-    go(num_pages_to_crawl, course_map_filename, index_filename)
+    go(args.num_pages_to_crawl, course_map_filename, index_filename,
+       num_workers=args.workers, cache_dir=args.cache_dir,
+       archive_dir=args.archive_dir, replay=args.replay,
+       state_filename=args.state, bloom_capacity=args.bloom_capacity,
+       report_filename=args.report, parser=args.parser,
+       stop_words=stop_words, index_workers=args.index_workers,
+       binary_index_filename=args.binary_index, max_postings=args.max_postings,
+       db_filename=args.db, checkpoint_filename=args.checkpoint,
+       resume=args.resume, checkpoint_every=args.checkpoint_every,
+       adaptive=args.adaptive, max_retries=args.max_retries, max_rate=args.max_rate,
+       positions=args.positions)
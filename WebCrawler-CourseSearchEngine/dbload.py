@@ -0,0 +1,222 @@
+"""
+Bulk load of the index into the catalog_index table of the course
+database, and of the positions of words and the BM25 statistics
+computed from them into the catalog_positions, catalog_scores and
+catalog_term_stats tables.
+"""
+# pylint: disable-msg=invalid-name
+
+import re
+import sqlite3
+import itertools
+
+TABLE = "catalog_index"
+DEFAULT_SCHEMA = ("CREATE TABLE catalog_index\n"
+                  "(\n"
+                  "    course_id integer,      -- course ID\n"
+                  "    word varchar(100)       -- word found in course title or description\n"
+                  ")")
+POSITIONS_TABLE = "catalog_positions"
+POSITIONS_SCHEMA = ("CREATE TABLE catalog_positions\n"
+                    "(\n"
+                    "    course_id integer,      -- course ID\n"
+                    "    word varchar(100),      -- word found in course title or description\n"
+                    "    positions blob          -- positions of the word in the course text,\n"
+                    "                            -- delta-encoded varints\n"
+                    ")")
+POSITIONS_INDEXES = ["CREATE INDEX catalog_positions_word "
+                     "ON catalog_positions (word, course_id)"]
+STOP_WORDS_TABLE = "catalog_stop_words"
+STOP_WORDS_SCHEMA = ("CREATE TABLE catalog_stop_words\n"
+                     "(\n"
+                     "    word varchar(100)       -- word left out of the index\n"
+                     ")")
+SCORES_TABLE = "catalog_scores"
+SCORES_SCHEMA = ("CREATE TABLE catalog_scores\n"
+                 "(\n"
+                 "    course_id integer,      -- course ID\n"
+                 "    word varchar(100),      -- word found in course title or description\n"
+                 "    score real              -- BM25 score of the word for the course\n"
+                 ")")
+SCORES_INDEXES = ["CREATE INDEX catalog_scores_word ON catalog_scores (word, course_id, score)"]
+TERM_STATS_TABLE = "catalog_term_stats"
+TERM_STATS_SCHEMA = ("CREATE TABLE catalog_term_stats\n"
+                     "(\n"
+                     "    word varchar(100),      -- word found in course titles or descriptions\n"
+                     "    df integer,             -- number of courses with the word\n"
+                     "    idf real,               -- BM25 inverse document frequency\n"
+                     "    max_score real          -- highest score of the word for a course\n"
+                     ")")
+TERM_STATS_INDEXES = ["CREATE UNIQUE INDEX catalog_term_stats_word "
+                      "ON catalog_term_stats (word)"]
+BATCH_SIZE = 10000
+
+# Settings for the loading connection only
+LOAD_PRAGMAS = ["PRAGMA synchronous = NORMAL",
+                "PRAGMA temp_store = MEMORY",
+                "PRAGMA cache_size = -65536"]
+
+
+def index_rows(index):
+    '''
+    Yield the (course_id, word) rows of an index (word -> course ids), in
+    the order of write_to_csv.
+    '''
+    for word, course_ids in index.items():
+        for course_id in sorted(course_ids):
+            yield course_id, word
+
+
+def replace_table(conn, table, default_schema, columns, rows, batch_size=BATCH_SIZE,
+                  default_indexes=()):
+    '''
+    Replace the contents of table with rows, in the transaction open on
+    conn.
+
+    The rows are inserted into a new table with no indexes, in batches.
+    The indexes of the old table (or default_indexes, if the table does
+    not exist yet) are then built on the new one, and the new table takes
+    the place of the old one.
+
+    Returns:
+        the number of rows loaded
+    '''
+    new_table = table + "_new"
+    row = conn.execute("SELECT sql FROM sqlite_master "
+                       "WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    schema = row[0] if row else default_schema
+    if row:
+        index_sql = [sql for (sql,) in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+    else:
+        index_sql = list(default_indexes)
+
+    conn.execute("DROP TABLE IF EXISTS " + new_table)
+    conn.execute(re.sub(r'^CREATE TABLE\s+("?)' + table + r'\1',
+                        "CREATE TABLE " + new_table, schema, count=1))
+
+    num_rows = 0
+    rows = iter(rows)
+    insert = "INSERT INTO {} ({}) VALUES ({})".format(
+        new_table, ", ".join(columns), ", ".join(["?"] * len(columns)))
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        conn.executemany(insert, batch)
+        num_rows += len(batch)
+
+    conn.execute("DROP TABLE IF EXISTS " + table)
+    conn.execute("ALTER TABLE {} RENAME TO {}".format(new_table, table))
+    for sql in index_sql:
+        conn.execute(sql)
+    has_stats = conn.execute("SELECT 1 FROM sqlite_master "
+                             "WHERE name = 'sqlite_stat1'").fetchone()
+    if has_stats:
+        # The statistics of the old table were dropped with it
+        conn.execute("ANALYZE " + table)
+    return num_rows
+
+
+def load_tables(db_filename, loads):
+    '''
+    Run replace_table(conn, *args) for every args in loads, in a single
+    transaction.  Readers see either the old tables or the fully loaded
+    new ones.
+
+    Returns:
+        the list of the numbers of rows loaded
+    '''
+    conn = sqlite3.connect(db_filename, isolation_level=None)
+    try:
+        for pragma in LOAD_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            counts = [replace_table(conn, *args) for args in loads]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return counts
+
+
+def index_loads(rows, batch_size=BATCH_SIZE):
+    '''
+    Return the load_tables loads of the catalog_index table.
+    '''
+    return [(TABLE, DEFAULT_SCHEMA, ("course_id", "word"), rows, batch_size)]
+
+
+def positions_loads(index, stop_words, batch_size=BATCH_SIZE):
+    '''
+    Return the load_tables loads of the catalog_positions,
+    catalog_scores, catalog_term_stats and catalog_stop_words tables
+    (see load_positions).
+    '''
+    score_rows, term_rows = index.bm25()
+    return [
+        (POSITIONS_TABLE, POSITIONS_SCHEMA, ("course_id", "word", "positions"),
+         index.rows(), batch_size, POSITIONS_INDEXES),
+        (SCORES_TABLE, SCORES_SCHEMA, ("course_id", "word", "score"),
+         score_rows, batch_size, SCORES_INDEXES),
+        (TERM_STATS_TABLE, TERM_STATS_SCHEMA, ("word", "df", "idf", "max_score"),
+         term_rows, batch_size, TERM_STATS_INDEXES),
+        (STOP_WORDS_TABLE, STOP_WORDS_SCHEMA, ("word",),
+         ((word,) for word in sorted(stop_words)), batch_size)]
+
+
+def load_index(rows, db_filename, batch_size=BATCH_SIZE):
+    '''
+    Replace the contents of the catalog_index table with rows (see
+    replace_table).
+
+    Inputs:
+        rows: iterable of (course_id, word) pairs
+        db_filename: name of the SQLite database
+        batch_size: number of rows per executemany call
+
+    Returns:
+        the number of rows loaded
+    '''
+    return load_tables(db_filename, index_loads(rows, batch_size))[0]
+
+
+def load_positions(index, stop_words, db_filename, batch_size=BATCH_SIZE):
+    '''
+    Replace the contents of the catalog_positions table with the
+    positions of a positional.PositionalIndex, the contents of the
+    catalog_scores and catalog_term_stats tables with its BM25 statistics
+    (see PositionalIndex.bm25), and the contents of the
+    catalog_stop_words table with stop_words, so that phrase queries skip
+    the same words as the index.
+
+    Inputs:
+        index: PositionalIndex
+        stop_words: words left out of the index
+        db_filename: name of the SQLite database
+        batch_size: number of rows per executemany call
+
+    Returns:
+        the number of position rows loaded
+    '''
+    return load_tables(db_filename, positions_loads(index, stop_words, batch_size))[0]
+
+
+def load_catalog(rows, db_filename, positional_index=None, stop_words=(),
+                 batch_size=BATCH_SIZE):
+    '''
+    Replace the catalog_index table with rows and, if positional_index is
+    given, the tables of load_positions, all in a single transaction, so
+    that readers never see postings without their positions and scores.
+
+    Returns:
+        the list of the numbers of rows loaded, in the order of the tables
+    '''
+    loads = index_loads(rows, batch_size)
+    if positional_index is not None:
+        loads += positions_loads(positional_index, stop_words, batch_size)
+    return load_tables(db_filename, loads)
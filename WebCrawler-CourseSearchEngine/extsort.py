@@ -0,0 +1,114 @@
+"""
+Memory-bounded index builder that spills sorted runs to disk.
+"""
+# pylint: disable-msg=invalid-name
+
+import os
+import csv
+import heapq
+import shutil
+import struct
+import tempfile
+
+PAIR = struct.Struct("<II")
+READ_PAIRS = 4096
+
+
+def read_run(filename):
+    '''
+    Yield the (rank, course_id) pairs of a run file, in order.
+    '''
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(PAIR.size * READ_PAIRS)
+            if not chunk:
+                return
+            yield from PAIR.iter_unpack(chunk)
+
+
+class SpillingIndex:
+    '''
+    Index (word -> course ids) that keeps at most max_postings postings
+    in memory.  When the buffer is full, its postings are sorted and
+    written to a run file, and the runs are k-way merged when the index
+    is written.
+
+    Postings are kept as (rank, course_id) pairs, where the rank of a
+    word is the order in which it was first added.  Merging the runs
+    therefore produces the words in the same order as the dict index
+    built by go(), each with its sorted course ids, and write_csv writes
+    the same file as write_to_csv.  Only the vocabulary (one entry per
+    distinct word) stays in memory.
+    '''
+
+    def __init__(self, max_postings, tmp_dir=None):
+        self.max_postings = max_postings
+        self.run_dir = tempfile.mkdtemp(prefix="index-runs-", dir=tmp_dir)
+        self.runs = []
+        self.ranks = {}  # word -> rank
+        self.words = []  # rank -> word
+        self.buffer = set()
+
+    def merge(self, page_index):
+        '''
+        Add the postings of page_index (word -> course ids).
+        '''
+        for word, course_ids in page_index.items():
+            rank = self.ranks.get(word)
+            if rank is None:
+                rank = self.ranks[word] = len(self.words)
+                self.words.append(word)
+            for course_id in course_ids:
+                self.buffer.add((rank, course_id))
+            if len(self.buffer) >= self.max_postings:
+                self.spill()
+
+    def spill(self):
+        '''
+        Write the buffered postings to a new sorted run.
+        '''
+        if not self.buffer:
+            return
+        filename = os.path.join(self.run_dir, "run-{:06d}".format(len(self.runs)))
+        with open(filename, "wb") as f:
+            for pair in sorted(self.buffer):
+                f.write(PAIR.pack(*pair))
+        self.runs.append(filename)
+        self.buffer = set()
+
+    def items(self):
+        '''
+        Yield the distinct (word, course_id) pairs of the index, in word
+        rank and course id order.
+        '''
+        runs = [read_run(filename) for filename in self.runs]
+        runs.append(iter(sorted(self.buffer)))
+        prev = None
+        for pair in heapq.merge(*runs):
+            if pair != prev:
+                yield self.words[pair[0]], pair[1]
+                prev = pair
+
+    def write_csv(self, filename):
+        '''
+        Write the index to a CSV file, like write_to_csv.
+        '''
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='|')
+            for word, course_id in self.items():
+                writer.writerow([course_id, word])
+
+    def close(self):
+        '''
+        Delete the run files and their directory.  Closing twice is
+        harmless.
+        '''
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.runs = []
+        self.buffer = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
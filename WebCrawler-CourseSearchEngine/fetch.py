@@ -0,0 +1,315 @@
+"""
+Fetch layer for the catalog crawler.
+"""
+# pylint: disable-msg=invalid-name
+
+import os
+import json
+import threading
+import itertools
+import email.message
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from bs4 import UnicodeDammit
+import util
+import pagestore
+
+VALIDATORS_FILENAME = "validators.json"
+PAGES_DIRNAME = "pages"
+
+# Responses worth retrying: the host is overloaded or briefly unavailable
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def make_session(pool_size=10):
+    '''
+    Create a requests session that keeps up to pool_size connections
+    per host alive.
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    '''
+    Return the session shared by every fetch in this process.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+class TransientError(Exception):
+    '''
+    A request failed in a way that may succeed if retried: a connection
+    error, a timeout or one of RETRY_STATUSES.  retry_after is the delay
+    (in seconds) asked for by the server, if any.
+    '''
+
+    def __init__(self, url, reason, retry_after=None):
+        super().__init__("{}: {}".format(url, reason))
+        self.url = url
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    '''
+    Return the delay in seconds of a Retry-After header given in seconds,
+    or None.
+    '''
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpCache:
+    '''
+    On-disk record of the ETag and Last-Modified validators of every page
+    fetched, along with the page contents, so that a later crawl can
+    send conditional requests and reuse the stored page on a 304.
+
+    Layout of cache_dir:
+        validators.json: url -> {"etag", "last_modified", "digest"}
+        pages/: PageStore with the contents read from the pages
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.pages = pagestore.PageStore(os.path.join(cache_dir, PAGES_DIRNAME))
+        self.validators = {}
+        filename = os.path.join(cache_dir, VALIDATORS_FILENAME)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.validators = json.load(f)
+        self.lock = threading.Lock()
+        self.num_not_modified = 0
+
+    def conditional_headers(self, url):
+        '''
+        Build the If-None-Match/If-Modified-Since headers for url.
+        '''
+        headers = {}
+        with self.lock:
+            entry = self.validators.get(url)
+        if entry is None:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def load(self, url):
+        '''
+        Return the stored contents of url, or None if there are none.
+        '''
+        with self.lock:
+            entry = self.validators.get(url)
+        if entry is None or not entry.get("digest"):
+            return None
+        return self.pages.get(entry["digest"])
+
+    def store(self, url, response, html):
+        '''
+        Record the validators of response and the contents read from it.
+        Pages served without validators are not stored.
+        '''
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        digest = self.pages.put(html)
+        with self.lock:
+            self.validators[url] = {"etag": etag,
+                                    "last_modified": last_modified,
+                                    "digest": digest}
+
+    def save(self):
+        '''
+        Write the validators to disk so that the next crawl can use them.
+        '''
+        filename = os.path.join(self.cache_dir, VALIDATORS_FILENAME)
+        with self.lock:
+            with open(filename + ".tmp", "w") as f:
+                json.dump(self.validators, f)
+        os.replace(filename + ".tmp", filename)
+
+
+def get_request(url, session=None, headers=None, timeout=None,
+                raise_transient=False):
+    '''
+    Same as util.get_request, but sends the request through a pooled
+    session, with optional extra headers and timeout (in seconds).
+
+    If raise_transient is True, failures that may succeed if retried
+    raise TransientError instead of returning None.
+
+    Outputs:
+        request object or None
+    '''
+    if not util.is_absolute_url(url):
+        return None
+    if session is None:
+        session = get_session()
+    try:
+        r = session.get(url, headers=headers, timeout=timeout)
+        if r.status_code == 404 or r.status_code == 403:
+            r = None
+    except (requests.ConnectionError, requests.Timeout,
+            requests.exceptions.ChunkedEncodingError) as e:
+        if raise_transient:
+            raise TransientError(url, type(e).__name__) from e
+        r = None
+    except Exception:  # pylint: disable=broad-except
+        # fail on any kind of error, like util.get_request
+        r = None
+    if raise_transient and r is not None and r.status_code in RETRY_STATUSES:
+        raise TransientError(url, "HTTP {}".format(r.status_code),
+                             parse_retry_after(r.headers.get("Retry-After")))
+    return r
+
+
+def read_page(request):
+    '''
+    Read the contents of the page of a request as UTF-8, decoded with the
+    charset of its Content-Type header, or else the one UnicodeDammit
+    finds in (or guesses from) the page, so that every parsing backend
+    sees the same text.
+
+    Returns:
+        bytes, or "" if the read fails
+    '''
+    message = email.message.Message()
+    message["Content-Type"] = request.headers.get("Content-Type", "")
+    charset = message.get_content_charset()
+    try:
+        if charset:
+            try:
+                return request.content.decode(charset).encode("utf-8")
+            except (LookupError, UnicodeDecodeError):
+                pass
+        return (UnicodeDammit(request.content, is_html=True).unicode_markup or "").encode("utf-8")
+    except Exception:
+        print("read failed: " + request.url)
+        return ""
+
+
+def fetch_page(url, session=None, cache=None, timeout=None, raise_transient=False):
+    '''
+    Fetch a page and read its contents.
+
+    Inputs:
+        url: absolute URL of the page
+        session: requests session to use (defaults to the shared session)
+        cache: optional HttpCache.  When given, the request is conditional
+          and a 304 response is answered from the cache.
+        timeout, raise_transient: see get_request
+
+    Returns:
+        (request, html) pair, or (None, None) if the request failed.
+    '''
+    headers = cache.conditional_headers(url) if cache is not None else None
+    request = get_request(url, session, headers, timeout, raise_transient)
+    if not request:
+        return None, None
+
+    if cache is not None and request.status_code == 304:
+        html = cache.load(url)
+        if html is not None:
+            with cache.lock:
+                cache.num_not_modified += 1
+            return request, html
+        # The stored page is gone: ask again without validators
+        request = get_request(url, session, timeout=timeout,
+                              raise_transient=raise_transient)
+        if not request:
+            return None, None
+
+    html = read_page(request)
+    if cache is not None:
+        cache.store(url, request, html)
+    return request, html
+
+
+def limit_in_flight(fetch_page, max_in_flight):
+    '''
+    Wrap fetch_page so that at most max_in_flight calls run at once.
+    '''
+    semaphore = threading.BoundedSemaphore(max_in_flight)
+
+    def limited_fetch_page(url):
+        with semaphore:
+            return fetch_page(url)
+    return limited_fetch_page
+
+
+class Prefetcher:
+    '''
+    Fetch the pages at the head of the crawl queue ahead of the crawl loop,
+    with at most num_workers requests in flight.
+
+    The crawl loop still consumes pages one at a time in queue order, so
+    the pages processed (and the index built from them) are exactly the
+    ones a serial crawl would produce.  With num_workers <= 1 every page
+    is fetched on demand.
+    '''
+
+    def __init__(self, num_workers=1, fetch=fetch_page):
+        self.fetch = fetch
+        self.lookahead = 2 * num_workers
+        self.pool = None
+        if num_workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = {}  # url -> future
+
+    def fill(self, urls_to_visit, already_visited):
+        '''
+        Start fetching the first unvisited URLs in the queue.
+
+        Inputs:
+            urls_to_visit: the crawl queue, in order
+            already_visited: container of URLs that will be skipped
+        '''
+        if self.pool is None:
+            return
+        window = itertools.islice(urls_to_visit, self.lookahead)
+        for url in window:
+            if url not in self.pending and url not in already_visited:
+                self.pending[url] = self.pool.submit(self.fetch, url)
+
+    def get(self, url):
+        '''
+        Return the result of fetch for url (by default, a (request, html)
+        pair), waiting for a prefetch in flight or fetching it now.
+        '''
+        future = self.pending.pop(url, None)
+        if future is None:
+            return self.fetch(url)
+        return future.result()
+
+    def close(self):
+        '''
+        Abandon the prefetches that the crawl did not use.
+        '''
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
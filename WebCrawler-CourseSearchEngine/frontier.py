@@ -0,0 +1,138 @@
+"""
+Crawl frontier: the queue of URLs to visit and the URLs already seen.
+"""
+# pylint: disable-msg=invalid-name
+
+import math
+import hashlib
+import functools
+from collections import deque
+import util
+
+URL_CACHE_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def convert_if_relative_url(current_url, new_url):
+    '''
+    Memoized util.convert_if_relative_url.
+    '''
+    return util.convert_if_relative_url(current_url, new_url)
+
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def is_url_ok_to_follow(url, limiting_domain):
+    '''
+    Memoized util.is_url_ok_to_follow.
+    '''
+    return util.is_url_ok_to_follow(url, limiting_domain)
+
+
+class BloomFilter:
+    '''
+    Set of strings with no false negatives and a false positive rate of
+    about error_rate once capacity strings have been added, in
+    -capacity * ln(error_rate) / ln(2)^2 bits.
+    '''
+
+    def __init__(self, capacity, error_rate=1e-6):
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate)
+                                             / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: position i is h1 + i * h2
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        '''
+        Add item to the filter.
+        '''
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+class Frontier:
+    '''
+    FIFO queue of the URLs to visit, with constant-time checks of whether
+    a URL is already queued or visited.
+
+    A URL is queued at most once at a time, and never once it has been
+    visited.  A URL that is popped but not marked as visited (because its
+    request failed) may be queued again.
+
+    For very large crawls, the visited set can be a BloomFilter sized for
+    bloom_capacity URLs.  It takes a fraction of the memory of a set, at
+    the cost of skipping the rare URL it wrongly reports as visited.
+    '''
+
+    def __init__(self, starting_urls, limiting_domain, bloom_capacity=None):
+        self.limiting_domain = limiting_domain
+        self.queue = deque()
+        self.queued = set()
+        if bloom_capacity:
+            self.visited = BloomFilter(bloom_capacity)
+        else:
+            self.visited = set()
+        for url in starting_urls:
+            self.push(url)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter(self.queue)
+
+    def push(self, url):
+        '''
+        Queue url unless it is already queued or visited.
+
+        Returns:
+            True if url was queued
+        '''
+        if url in self.queued or url in self.visited:
+            return False
+        self.queue.append(url)
+        self.queued.add(url)
+        return True
+
+    def pop(self):
+        '''
+        Remove and return the next URL to visit.
+        '''
+        url = self.queue.popleft()
+        self.queued.discard(url)
+        return url
+
+    def mark_visited(self, url):
+        '''
+        Record that url has been visited.
+        '''
+        self.visited.add(url)
+
+    def is_visited(self, url):
+        '''
+        Has url been visited?
+        '''
+        return url in self.visited
+
+    def find_links(self, hrefs, current_url):
+        '''
+        Resolve the hrefs of the links of the page at current_url and
+        return the URLs that are OK to follow, in page order.
+        '''
+        links = []
+        for href in hrefs:
+            full_url = convert_if_relative_url(current_url, href)
+            if full_url and is_url_ok_to_follow(full_url, self.limiting_domain):
+                links.append(full_url)
+        return links
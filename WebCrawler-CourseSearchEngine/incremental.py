@@ -0,0 +1,131 @@
+"""
+Crawl state for incremental re-crawls.
+"""
+# pylint: disable-msg=invalid-name
+
+import os
+import csv
+import json
+import hashlib
+
+
+def digest_page(html):
+    '''
+    Return the SHA-256 digest of the contents of a page.
+    '''
+    if isinstance(html, str):
+        html = html.encode("iso-8859-1", errors="replace")
+    return hashlib.sha256(html).hexdigest()
+
+
+def digest_config(course_map, stop_words):
+    '''
+    Return a digest of the course map and stop words, so that a state
+    built with a different configuration is not reused.
+    '''
+    text = json.dumps([course_map, sorted(stop_words)], sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CrawlState:
+    '''
+    What the last crawl learned from every page it processed: the digest
+    of the page, the URLs it links to and the postings (word -> course
+    ids) it added to the index.
+
+    A page whose digest has not changed since the last crawl does not
+    need to be parsed again: its links and postings are reused.
+    '''
+
+    def __init__(self, filename, course_map, stop_words=()):
+        self.filename = filename
+        self.config_digest = digest_config(course_map, stop_words)
+        self.old_pages = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                state = json.load(f)
+            if state.get("config") == self.config_digest:
+                self.old_pages = state["pages"]
+        self.pages = {}
+        self.num_reused = 0
+        self.num_changed = 0
+
+    def is_unchanged(self, url, digest, positions=False):
+        '''
+        Did the last crawl record url with the same digest (and, if
+        positions is True, with the positions of its words)?
+        '''
+        entry = self.old_pages.get(url)
+        return (entry is not None and entry["digest"] == digest
+                and (not positions or "positions" in entry))
+
+    def lookup(self, url, digest, positions=False):
+        '''
+        Return the (links, postings, positions) the last crawl recorded
+        for url, or None if the page has changed or was not crawled, or
+        if positions is True and the last crawl did not record them.
+        '''
+        if not self.is_unchanged(url, digest, positions):
+            return None
+        entry = self.old_pages[url]
+        self.pages[url] = entry
+        self.num_reused += 1
+        return entry["links"], entry["postings"], entry.get("positions")
+
+    def record(self, url, digest, links, postings, positions=None):
+        '''
+        Record what this crawl learned from a changed or new page.
+
+        Inputs:
+            url: URL of the page
+            digest: digest of the page contents
+            links: list of the URLs the page links to that may be followed
+            postings: dict of word -> set of course ids from the page
+            positions: optional positions of the words of the page's
+              courses (see crawler.index_course_blocks)
+        '''
+        entry = {"digest": digest,
+                 "links": links,
+                 "postings": {word: sorted(ids) for word, ids in postings.items()}}
+        if positions is not None:
+            entry["positions"] = positions
+        self.pages[url] = entry
+        self.num_changed += 1
+
+    def delta(self, index):
+        '''
+        Compare index with the index built by the last crawl.
+
+        Returns:
+            (added, removed) pair of sets of (course_id, word) pairs
+        '''
+        old_pairs = set()
+        for entry in self.old_pages.values():
+            for word, ids in entry["postings"].items():
+                old_pairs.update((course_id, word) for course_id in ids)
+        new_pairs = set()
+        for word, ids in index.items():
+            new_pairs.update((course_id, word) for course_id in ids)
+        return new_pairs - old_pairs, old_pairs - new_pairs
+
+    def save(self):
+        '''
+        Write the state of this crawl for the next one.
+        '''
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump({"config": self.config_digest,
+                       "pages": self.pages}, f)
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+def write_delta(added, removed, filename):
+    '''
+    Write the changes to the index as a CSV file with rows of the form
+    +|course_id|word for added pairs and -|course_id|word for removed ones.
+    '''
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='|')
+        for course_id, word in sorted(removed):
+            writer.writerow(['-', course_id, word])
+        for course_id, word in sorted(added):
+            writer.writerow(['+', course_id, word])
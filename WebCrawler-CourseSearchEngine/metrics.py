@@ -0,0 +1,155 @@
+"""
+Counters and timers for the crawler.
+"""
+# pylint: disable-msg=invalid-name
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class CrawlMetrics:
+    '''
+    Counters and timers collected during a crawl.
+
+    Counters:
+        pages: pages processed
+        pages_failed: requests that failed
+        pages_not_modified: pages answered by a 304
+        pages_reused: unchanged pages not reindexed (incremental crawls)
+        pages_resumed: pages replayed from a checkpoint
+        fetch_errors/fetch_retries: transient request failures, and the
+          retries they led to (adaptive scheduling)
+        bytes_downloaded: size of the page bodies downloaded
+        course_blocks: course blocks found
+        courses_matched/courses_unmatched: course codes found in pages that
+          are/are not in the course map
+
+    Timers (seconds): fetch (latency of each request, measured in the
+    fetching thread), parse, index and links.
+
+    failures: url -> reason, for the pages that still failed after being
+    retried.
+
+    callback, if given, is called as callback(url, metrics) after each
+    page is processed.
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.counters = {}
+        self.timers = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def incr(self, name, n=1):
+        '''
+        Add n to the counter name.
+        '''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        '''
+        Record one measurement of the timer name.
+        '''
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {"count": 0, "total": 0.0, "max": 0.0}
+            timer["count"] += 1
+            timer["total"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+
+    def merge(self, counters, timers):
+        '''
+        Add the counters and timers of another CrawlMetrics (for example,
+        one kept by a worker process).
+        '''
+        with self.lock:
+            for name, n in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, other in timers.items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    timer = self.timers[name] = {"count": 0, "total": 0.0, "max": 0.0}
+                timer["count"] += other["count"]
+                timer["total"] += other["total"]
+                timer["max"] = max(timer["max"], other["max"])
+
+    def record_failure(self, url, reason):
+        '''
+        Record a page that could not be fetched, and why.
+        '''
+        with self.lock:
+            self.failures[url] = reason
+
+    @contextmanager
+    def timer(self, name):
+        '''
+        Time the body of a with statement.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed_fetch(self, fetch_page):
+        '''
+        Wrap fetch_page to record the latency and size of each request.
+        '''
+        def fetch_and_measure(url):
+            start = time.perf_counter()
+            request, html = fetch_page(url)
+            self.observe("fetch", time.perf_counter() - start)
+            if not request:
+                self.incr("pages_failed")
+            elif getattr(request, "status_code", None) == 304:
+                self.incr("pages_not_modified")
+            else:
+                self.incr("bytes_downloaded", len(getattr(request, "content", b"")))
+            return request, html
+        return fetch_and_measure
+
+    def page_done(self, url):
+        '''
+        Count a processed page and call the callback.
+        '''
+        self.incr("pages")
+        if self.callback is not None:
+            self.callback(url, self)
+
+    def finish(self):
+        '''
+        Stop the crawl clock.
+        '''
+        self.end_time = time.perf_counter()
+
+    def report(self):
+        '''
+        Return the metrics as a JSON-serializable dict.
+        '''
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        elapsed = end_time - self.start_time
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {name: dict(timer, mean=timer["total"] / timer["count"])
+                      for name, timer in self.timers.items()}
+            failures = dict(self.failures)
+        pages = counters.get("pages", 0)
+        return {"elapsed": elapsed,
+                "pages_per_sec": pages / elapsed if elapsed > 0 else 0.0,
+                "counters": counters,
+                "timers": timers,
+                "failures": failures}
+
+    def write_report(self, filename):
+        '''
+        Write the report to a JSON file.
+        '''
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
@@ -0,0 +1,130 @@
+"""
+Content-addressed on-disk store of crawled pages.
+"""
+# pylint: disable-msg=invalid-name
+
+import os
+import json
+import zlib
+import hashlib
+import threading
+from collections import namedtuple
+
+OBJECTS_DIRNAME = "objects"
+INDEX_FILENAME = "index.jsonl"
+
+# Stand-in for the request object of a page read from the store
+ArchivedRequest = namedtuple("ArchivedRequest", ["url"])
+
+
+class PageStore:
+    '''
+    Archive of page contents, compressed with zlib and stored once per
+    distinct contents under their SHA-256 digest, plus an index from URL
+    to digest.
+
+    Layout of store_dir:
+        objects/ab/cdef...: compressed contents with digest abcdef...
+        index.jsonl: one {"url", "digest"} record per line, appended as
+          pages are recorded.  The last record for a URL wins, and a
+          digest of null records a fetch that failed.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, OBJECTS_DIRNAME)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index_filename = os.path.join(store_dir, INDEX_FILENAME)
+        self.index = {}  # url -> digest or None
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn last line of an interrupted crawl
+                        continue
+                    self.index[record["url"]] = record["digest"]
+        self.lock = threading.Lock()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def put(self, html):
+        '''
+        Store html (bytes or str) and return its digest.
+        '''
+        if isinstance(html, str):
+            html = html.encode("iso-8859-1", errors="replace")
+        digest = hashlib.sha256(html).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp, "wb") as f:
+                f.write(zlib.compress(html))
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest):
+        '''
+        Return the contents stored under digest, or None.
+        '''
+        try:
+            with open(self._object_path(digest), "rb") as f:
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            return None
+
+    def record(self, url, html):
+        '''
+        Store html as the contents of url.  html is None for a page that
+        could not be fetched.
+
+        Returns:
+            the digest of the contents, or None
+        '''
+        digest = self.put(html) if html is not None else None
+        with self.lock:
+            if url in self.index and self.index[url] == digest:
+                return digest
+            self.index[url] = digest
+            with open(self.index_filename, "a") as f:
+                f.write(json.dumps({"url": url, "digest": digest}) + "\n")
+        return digest
+
+    def lookup(self, url):
+        '''
+        Return the digest recorded for url, or None.
+        '''
+        with self.lock:
+            return self.index.get(url)
+
+    def load(self, url):
+        '''
+        Return the contents recorded for url, or None.
+        '''
+        digest = self.lookup(url)
+        if digest is None:
+            return None
+        return self.get(digest)
+
+    def fetch_page(self, url):
+        '''
+        Replay a page from the store, with the same outputs as
+        fetch.fetch_page.  Pages missing from the store fail.
+        '''
+        html = self.load(url)
+        if html is None:
+            return None, None
+        return ArchivedRequest(url), html
+
+    def recording(self, fetch_page):
+        '''
+        Wrap fetch_page so that every page it fetches is recorded.
+        '''
+        def fetch_and_record(url):
+            request, html = fetch_page(url)
+            self.record(url, html if request else None)
+            return request, html
+        return fetch_and_record
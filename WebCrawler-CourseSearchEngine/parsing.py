@@ -0,0 +1,184 @@
+"""
+HTML parsing backends for the crawler.
+
+Every backend turns the contents of a page into the two things the
+crawler needs from it: the course blocks and the links.
+"""
+# pylint: disable-msg=invalid-name
+
+import re
+from collections import namedtuple
+from bs4 import BeautifulSoup, UnicodeDammit
+import util
+
+try:
+    import lxml.html
+    import lxml.etree
+except ImportError:
+    lxml = None
+
+# A course block of the catalog.  subsequences is the list of
+# (title, description) pairs of the courses in a sequence, with a
+# description of None for a course that has none.
+CourseBlock = namedtuple("CourseBlock", ["title", "description", "subsequences"])
+
+DEFAULT_PARSER = "html5lib"
+
+
+# lxml refuses text that starts with an encoding declaration
+XML_DECLARATION_RE = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+
+def decode_page(html):
+    '''
+    Decode the contents of a page once, for every backend: UTF-8 (what
+    fetch.read_page stores), or else the encoding the page declares or
+    UnicodeDammit guesses.  Text is returned as is.
+    '''
+    if isinstance(html, bytes):
+        html = UnicodeDammit(html, known_definite_encodings=["utf-8"],
+                             is_html=True).unicode_markup or ""
+    return XML_DECLARATION_RE.sub("", html, count=1)
+
+
+def soup_course_blocks(soup):
+    '''
+    Extract the course blocks from a BeautifulSoup tree.  Blocks without
+    a title are skipped.
+    '''
+    blocks = []
+    for course_block in soup.find_all('div', class_="courseblock main"):
+        title_tag = course_block.find('p', class_="courseblocktitle")
+        if not title_tag:
+            continue
+        desc_tag = course_block.find('p', class_="courseblockdesc")
+        description = desc_tag.text.strip() if desc_tag else ""
+
+        subsequences = []
+        for subsequence in util.find_sequence(course_block):
+            sub_title_tag = subsequence.find('p', class_="courseblocktitle")
+            sub_desc_tag = subsequence.find('p', class_="courseblockdesc")
+            subsequences.append(
+                (sub_title_tag.text.strip() if sub_title_tag else "",
+                 sub_desc_tag.text.strip() if sub_desc_tag else None))
+
+        blocks.append(CourseBlock(title_tag.text.strip(), description, subsequences))
+    return blocks
+
+
+class SoupPage:
+    '''
+    Page parsed into a full BeautifulSoup tree with one of the parsers
+    BeautifulSoup supports ("html5lib", "lxml", "html.parser").
+    '''
+
+    def __init__(self, html, features=DEFAULT_PARSER):
+        self.soup = BeautifulSoup(html, features)
+
+    def course_blocks(self):
+        '''
+        Return the list of CourseBlocks of the page.
+        '''
+        return soup_course_blocks(self.soup)
+
+    def links(self):
+        '''
+        Return the href of every link of the page, in page order.
+        '''
+        return [link['href'] for link in self.soup.find_all('a', href=True)]
+
+
+# Class tests that match like BeautifulSoup's class_ argument
+MAIN_BLOCK_XPATH = '//div[normalize-space(@class) = "courseblock main"]'
+TITLE_XPATH = ('.//p[contains(concat(" ", normalize-space(@class), " "),'
+               ' " courseblocktitle ")]')
+DESC_XPATH = ('.//p[contains(concat(" ", normalize-space(@class), " "),'
+              ' " courseblockdesc ")]')
+
+
+class LxmlPage:
+    '''
+    Page parsed with lxml, with targeted XPath extraction of the course
+    blocks and links instead of a walk over a BeautifulSoup tree.
+
+    Subsequences are found like util.find_sequence: the elements that
+    directly follow the block, with no text in between, and whose class
+    is exactly "courseblock subsequence".
+    '''
+
+    def __init__(self, html):
+        if lxml is None:
+            raise ValueError("the lxml parser needs the lxml package")
+        try:
+            self.root = lxml.html.document_fromstring(html)
+        except (lxml.etree.ParserError, ValueError):
+            # empty page
+            self.root = None
+
+    @staticmethod
+    def _first_text(element, xpath):
+        found = element.xpath(xpath)
+        if not found:
+            return None
+        return found[0].text_content().strip()
+
+    @staticmethod
+    def _is_subsequence(element):
+        return (isinstance(element, lxml.html.HtmlElement) and
+                element.get("class", "").split() == ["courseblock", "subsequence"])
+
+    def course_blocks(self):
+        '''
+        Return the list of CourseBlocks of the page.
+        '''
+        if self.root is None:
+            return []
+        blocks = []
+        for course_block in self.root.xpath(MAIN_BLOCK_XPATH):
+            title = self._first_text(course_block, TITLE_XPATH)
+            if title is None:
+                continue
+            description = self._first_text(course_block, DESC_XPATH) or ""
+
+            subsequences = []
+            prev, sib = course_block, course_block.getnext()
+            while not prev.tail and self._is_subsequence(sib):
+                subsequences.append((self._first_text(sib, TITLE_XPATH) or "",
+                                     self._first_text(sib, DESC_XPATH)))
+                prev, sib = sib, sib.getnext()
+
+            blocks.append(CourseBlock(title, description, subsequences))
+        return blocks
+
+    def links(self):
+        '''
+        Return the href of every link of the page, in page order.
+        '''
+        if self.root is None:
+            return []
+        return [str(href) for href in self.root.xpath('//a/@href')]
+
+
+PARSERS = {
+    "html5lib": lambda html: SoupPage(html, "html5lib"),
+    "lxml": lambda html: SoupPage(html, "lxml"),
+    "html.parser": lambda html: SoupPage(html, "html.parser"),
+    "lxml-fast": LxmlPage,
+}
+
+
+def parse_page(html, parser=DEFAULT_PARSER):
+    '''
+    Parse the contents of a page.
+
+    Inputs:
+        html: contents of the page, bytes (see decode_page) or text
+        parser: name of a backend in PARSERS
+
+    Returns:
+        a page object with course_blocks() and links() methods
+    '''
+    if parser not in PARSERS:
+        raise ValueError("unknown parser {}: expected one of {}".format(
+            parser, ", ".join(sorted(PARSERS))))
+    return PARSERS[parser](decode_page(html))
@@ -0,0 +1,145 @@
+"""
+Positional index: where each word occurs in the text of each course.
+"""
+# pylint: disable-msg=invalid-name
+
+import math
+from binindex import encode_postings, decode_postings
+
+# Positions skipped between two pieces of text of a course (title,
+# description, ...), so that phrases do not match across them
+POSITION_GAP = 100
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def course_document(fields):
+    '''
+    Combine the positions of the pieces of text of a course into the
+    positions of one document, POSITION_GAP apart.
+
+    Inputs:
+        fields: list of (term -> positions, number of words) pairs, as
+          returned by Analyzer.positions
+
+    Returns:
+        (dict of term -> list of positions, length) pair
+    '''
+    term_positions = {}
+    offset = 0
+    for i, (field_positions, length) in enumerate(fields):
+        if i:
+            offset += POSITION_GAP
+        for term, positions in field_positions.items():
+            term_positions.setdefault(term, []).extend(p + offset for p in positions)
+        offset += length
+    return term_positions, offset
+
+
+def encode_positions(positions):
+    '''
+    Delta-encode a sorted list of positions as varints (the encoding of
+    binindex.encode_postings).
+    '''
+    return encode_postings(positions)
+
+
+def decode_positions(data):
+    '''
+    Decode delta-encoded positions.
+    '''
+    return decode_postings(data)
+
+
+class PositionalIndex:
+    '''
+    Positions of the terms of every course (course id -> term ->
+    positions).
+
+    The text of a course may come from several course blocks, on one
+    page or on several.  The documents of a course are added in crawl
+    order by merge, each one POSITION_GAP after the previous one, so the
+    positions do not depend on how the pages were processed.
+    '''
+
+    def __init__(self):
+        self.courses = {}  # course id -> term -> positions
+        self.lengths = {}  # course id -> length of its text so far
+        self.sizes = {}  # course id -> number of words of its text
+
+    def merge(self, page_positions):
+        '''
+        Add the documents of a page.
+
+        Inputs:
+            page_positions: list of [course_id, term -> positions, length]
+              entries, in page order
+        '''
+        for course_id, term_positions, length in page_positions:
+            offset = self.lengths.get(course_id)
+            if offset is None:
+                offset = 0
+                course = self.courses[course_id] = {}
+            else:
+                offset += POSITION_GAP
+                course = self.courses[course_id]
+            for term, positions in term_positions.items():
+                course.setdefault(term, []).extend(p + offset for p in positions)
+            self.lengths[course_id] = offset + length
+            self.sizes[course_id] = self.sizes.get(course_id, 0) + length
+
+    def positions(self, course_id, term):
+        '''
+        Return the sorted positions of term in the text of course_id.
+        '''
+        return self.courses.get(course_id, {}).get(term, [])
+
+    def bm25(self, k1=K1, b=B):
+        '''
+        Compute the BM25 score of every (term, course) pair, with the
+        number of positions of the term as its frequency and the number
+        of words of the course's text as its length, and the statistics of
+        every term.  Summing the scores of the query terms a course
+        contains gives its BM25 score for the query.
+
+        Returns:
+            (score_rows, term_rows) pair: lists of (course_id, word, score)
+            and (word, df, idf, max_score) tuples, where df is the number
+            of courses with the word and max_score the highest score of
+            the word, sorted
+        '''
+        num_courses = len(self.courses)
+        df = {}
+        for course in self.courses.values():
+            for term in course:
+                df[term] = df.get(term, 0) + 1
+        idf = {term: math.log(1 + (num_courses - n + 0.5) / (n + 0.5))
+               for term, n in df.items()}
+        avg_size = sum(self.sizes.values()) / num_courses if num_courses else 0.0
+
+        score_rows = []
+        max_score = {}
+        for course_id in sorted(self.courses):
+            course = self.courses[course_id]
+            norm = k1 * (1 - b + b * self.sizes[course_id] / avg_size) if avg_size else k1
+            for term in sorted(course):
+                tf = len(course[term])
+                score = idf[term] * tf * (k1 + 1) / (tf + norm)
+                score_rows.append((course_id, term, score))
+                if score > max_score.get(term, 0.0):
+                    max_score[term] = score
+        term_rows = [(term, df[term], idf[term], max_score.get(term, 0.0))
+                     for term in sorted(df)]
+        return score_rows, term_rows
+
+    def rows(self):
+        '''
+        Yield (course_id, word, encoded positions) rows, in course id and
+        word order.
+        '''
+        for course_id in sorted(self.courses):
+            course = self.courses[course_id]
+            for term in sorted(course):
+                yield course_id, term, encode_positions(course[term])
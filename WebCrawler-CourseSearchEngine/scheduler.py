@@ -0,0 +1,204 @@
+"""
+Adaptive per-host scheduling of the crawler's requests.
+"""
+# pylint: disable-msg=invalid-name
+
+import time
+import random
+import threading
+import urllib.parse
+from fetch import TransientError
+
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.1
+BACKOFF_CAP = 10.0
+DECREASE_FACTOR = 0.5
+SLOW_FACTOR = 2.0
+# Latency differences below this (in seconds) are noise, not congestion
+LATENCY_SLACK = 0.01
+LATENCY_ALPHA = 0.2
+
+
+class HostLimit:
+    '''
+    Concurrency limit of one host, adapted AIMD-style from the outcome of
+    its requests: every request that succeeds at about the best latency
+    seen so far adds 1/limit to the limit (about one more request in
+    flight per round of requests), while an error or a smoothed latency
+    over slow_factor times the best one multiplies it by decrease_factor,
+    at most once per round trip.
+
+    If max_rate is given, request starts are also spaced at least
+    1/max_rate seconds apart, and a Retry-After from the host holds back
+    every request to it for that long.
+    '''
+
+    def __init__(self, max_concurrency, initial_concurrency=1, max_rate=None,
+                 decrease_factor=DECREASE_FACTOR, slow_factor=SLOW_FACTOR):
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.interval = 1.0 / max_rate if max_rate else 0.0
+        self.decrease_factor = decrease_factor
+        self.slow_factor = slow_factor
+        self.in_flight = 0
+        self.next_start = 0.0
+        self.min_latency = None
+        self.latency = None  # smoothed
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        '''
+        Wait until a request to the host may start.
+        '''
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.in_flight < int(self.limit) and now >= self.next_start:
+                    break
+                self.cond.wait(self.next_start - now if now < self.next_start else None)
+            self.in_flight += 1
+            if self.interval:
+                self.next_start = max(now, self.next_start) + self.interval
+
+    def release(self, latency=None, error=False, retry_after=None):
+        '''
+        Record the outcome of a request that acquire let start.
+
+        Inputs:
+            latency: seconds the request took, if it succeeded
+            error: True if the request failed with a TransientError
+            retry_after: delay asked for by the host, if any
+        '''
+        with self.cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if error:
+                self._decrease(now)
+                if retry_after:
+                    self.next_start = max(self.next_start, now + retry_after)
+            elif latency is not None:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += LATENCY_ALPHA * (latency - self.latency)
+                if self.latency > self.slow_factor * self.min_latency + LATENCY_SLACK:
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.limit + 1.0 / self.limit, self.max_concurrency)
+            self.cond.notify_all()
+
+    def _decrease(self, now):
+        # Requests already in flight saw the same conditions: count them
+        # as one congestion signal
+        if now - self.last_decrease >= (self.latency or 0.0):
+            self.limit = max(self.limit * self.decrease_factor, 1.0)
+            self.last_decrease = now
+
+
+class AdaptiveScheduler:
+    '''
+    Schedule requests per host (see HostLimit), retrying transient
+    failures with capped exponential backoff and full jitter.
+
+    A page that still fails after max_retries retries is recorded in
+    failed (url -> reason) and in metrics, if given, instead of being
+    dropped silently.
+
+    Inputs:
+        max_concurrency: maximum number of requests in flight per host
+        initial_concurrency: starting number of requests in flight per host
+        max_retries: number of retries of a request after a transient error
+        max_rate: optional maximum number of requests per second per host
+        backoff_base, backoff_cap: the wait before retry n is drawn
+          uniformly between 0 and min(backoff_cap, backoff_base * 2 ** n)
+          seconds, and is at least the host's Retry-After
+        metrics: optional CrawlMetrics for the fetch_retries and
+          fetch_errors counters and the failures
+        rng: random.Random for the jitter
+        sleep: function used to wait before a retry
+    '''
+
+    def __init__(self, max_concurrency, initial_concurrency=1, max_retries=MAX_RETRIES,
+                 max_rate=None, backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP,
+                 metrics=None, rng=None, sleep=time.sleep):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.initial_concurrency = initial_concurrency
+        self.max_retries = max_retries
+        self.max_rate = max_rate
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.metrics = metrics
+        self.rng = rng if rng is not None else random.Random()
+        self.sleep = sleep
+        self.hosts = {}  # host -> HostLimit
+        self.failed = {}  # url -> reason
+        self.lock = threading.Lock()
+
+    def host_limit(self, url):
+        '''
+        Return the HostLimit of the host of url.
+        '''
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            limit = self.hosts.get(host)
+            if limit is None:
+                limit = self.hosts[host] = HostLimit(self.max_concurrency,
+                                                     self.initial_concurrency,
+                                                     self.max_rate)
+            return limit
+
+    def backoff(self, attempt, retry_after=None):
+        '''
+        Return the wait in seconds before retry number attempt.
+        '''
+        with self.lock:
+            delay = self.rng.uniform(0, min(self.backoff_cap,
+                                            self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+    def scheduled(self, fetch_page):
+        '''
+        Wrap fetch_page, which must raise TransientError on failures
+        worth retrying (see fetch.fetch_page), to run under the limit of
+        the page's host and retry.  The wrapped function returns
+        (None, None) for a page that keeps failing.
+        '''
+        def scheduled_fetch_page(url):
+            limit = self.host_limit(url)
+            for attempt in range(self.max_retries + 1):
+                limit.acquire()
+                start = time.perf_counter()
+                try:
+                    result = fetch_page(url)
+                except TransientError as e:
+                    limit.release(error=True, retry_after=e.retry_after)
+                    self._count("fetch_errors")
+                    if attempt == self.max_retries:
+                        with self.lock:
+                            self.failed[url] = e.reason
+                        if self.metrics is not None:
+                            self.metrics.record_failure(url, e.reason)
+                        return None, None
+                    self._count("fetch_retries")
+                    self.sleep(self.backoff(attempt, e.retry_after))
+                    continue
+                except BaseException:
+                    limit.release()
+                    raise
+                limit.release(latency=time.perf_counter() - start)
+                return result
+        return scheduled_fetch_page
+
+    def limits(self):
+        '''
+        Return the current concurrency limit of every host.
+        '''
+        with self.lock:
+            return {host: limit.limit for host, limit in self.hosts.items()}
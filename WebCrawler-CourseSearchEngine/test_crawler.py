@@ -5,8 +5,23 @@ PA1: Test code for the Mini Crawler/Indexer.
 
 import csv
 import json
+import os
+import contextlib
+import multiprocessing
 import sys
+import tempfile
 import crawler 
+import frontier
+import analyzer
+import binindex
+import extsort
+import dbload
+import positional
+import bench_server
+import scheduler
+import fetch
+import parsing
+import sqlite3
 import pytest 
 
 TEST_DATA = [(7, 'academically', 'Basic course: word from description', True),
@@ -46,6 +61,11 @@ TEST_DATA = [(7, 'academically', 'Basic course: word from description', True),
 
 DATA_DIR = "./data/"
 
+# Set CRAWLER_ARCHIVE_DIR to a page archive recorded by an earlier crawl
+# (crawler.py --archive-dir) to run the tests without the network.
+ARCHIVE_DIR = os.environ.get("CRAWLER_ARCHIVE_DIR")
+GO_OPTIONS = {"archive_dir": ARCHIVE_DIR, "replay": True} if ARCHIVE_DIR else {}
+
 
 def load_and_invert(filename):
     rv = {}
@@ -123,19 +143,392 @@ def test_crawler_csv_1():
      ''' 
         TEST: Checking whether crawler stops after 1 page...
      ''' 
-     crawler.go(1, "course_map.json", "catalog-index-empty.csv")
+     crawler.go(1, "course_map.json", "catalog-index-empty.csv", **GO_OPTIONS)
      load_csv("catalog-index-empty.csv", ci_to_cn, 0)
 
 def test_crawler_csv_2(): 
     ''' 
         TEST: Loading crawler result and testing contents.
     ''' 
-    crawler.go(num_pages_to_crawl, "course_map.json", "catalog-index.csv")
+    crawler.go(num_pages_to_crawl, "course_map.json", "catalog-index.csv", **GO_OPTIONS)
     d = load_csv("catalog-index.csv", ci_to_cn, 3)
 
+# Crawls of the local synthetic catalog that must write the same CSV as a
+# serial crawl: (options of each crawl, counter of the last crawl that
+# must equal the number of pages).  Path options are relative to tmp_path.
+LOCAL_PAGES = 60
+LOCAL_CRAWLS = {
+    "workers": ([{"num_workers": 8}], None),
+    "index_workers": ([{"index_workers": 2}], None),
+    "lxml": ([{"parser": "lxml"}], None),
+    "html.parser": ([{"parser": "html.parser"}], None),
+    "lxml-fast": ([{"parser": "lxml-fast"}], None),
+    "cache": ([{"cache_dir": "cache"}] * 2, "pages_not_modified"),
+    "replay": ([{"archive_dir": "archive"}, {"archive_dir": "archive", "replay": True}],
+               None),
+    "incremental": ([{"state_filename": "state.json"}] * 2, "pages_reused"),
+}
+PATH_OPTIONS = {"cache_dir", "archive_dir", "state_filename"}
+
+
+@contextlib.contextmanager
+def serve_catalog(**server_options):
+    '''
+    Serve a local synthetic catalog (see bench_server.start_server), of
+    LOCAL_PAGES pages unless server_options say otherwise.
+
+    Yields: the options of go to crawl it
+    '''
+    server_options.setdefault("num_pages", LOCAL_PAGES)
+    server, starting_url, limiting_domain = bench_server.start_server(**server_options)
+    try:
+        yield {"starting_url": starting_url, "limiting_domain": limiting_domain}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def catalog_server(request):
+    '''
+    Serve a local synthetic catalog for one test, with the server options
+    of the test's indirect parameter, if any (see serve_catalog).
+
+    Yields: the options of go to crawl it
+    '''
+    with serve_catalog(**getattr(request, "param", {})) as options:
+        yield options
+
+@pytest.fixture(scope="module")
+def local_catalog(tmp_path_factory):
+    '''
+    Serve the local synthetic catalog, and crawl it serially once.
+
+    Yields: (options of go to crawl it, contents of the serial CSV)
+    '''
+    with serve_catalog() as options:
+        serial = str(tmp_path_factory.mktemp("serial") / "serial.csv")
+        metrics = crawler.go(100, "course_map.json", serial, **options)
+        assert metrics.counters["pages"] == LOCAL_PAGES
+        with open(serial, "rb") as f:
+            expected = f.read()
+        assert expected.count(b"\n") > LOCAL_PAGES
+        assert "naïve".encode("utf-8") in expected
+        yield options, expected
+
+class Interrupted(Exception):
+    '''
+    Raised by the metrics callback of interrupt_at.
+    '''
+
+def interrupt_at(num_pages):
+    '''
+    Return a metrics callback that interrupts a crawl once it has
+    processed num_pages pages.
+    '''
+    def interrupt(url, metrics):
+        if metrics.counters["pages"] == num_pages:
+            raise Interrupted()
+    return interrupt
+
+@pytest.mark.parametrize("crawl", sorted(LOCAL_CRAWLS))
+def test_crawler_csv_local(crawl, local_catalog, tmp_path):
+    ''' 
+        TEST: Checking that workers, parsers, caches, replays and incremental crawls write the same CSV as a serial crawl.
+    ''' 
+    options, expected = local_catalog
+    runs, counter = LOCAL_CRAWLS[crawl]
+    filename = str(tmp_path / "index.csv")
+    for extra in runs:
+        extra = {key: str(tmp_path / value) if key in PATH_OPTIONS else value
+                 for key, value in extra.items()}
+        metrics = crawler.go(100, "course_map.json", filename, **options, **extra)
+        with open(filename, "rb") as f:
+            assert f.read() == expected
+    if counter:
+        assert metrics.counters[counter] == LOCAL_PAGES
+    if crawl == "incremental":
+        with open(str(tmp_path / "index-delta.csv")) as f:
+            assert f.read() == ""
+
+def test_parsers_decode_once():
+    ''' 
+        TEST: Checking that every parsing backend reads the same text from pages in any encoding.
+    ''' 
+    block = ('<div class="courseblock main"><p class="courseblocktitle">ANTH 1. Naïve Café.</p>'
+             '<p class="courseblockdesc">Résumé</p></div>')
+    pages = [("<html><body>" + block + "</body></html>").encode("utf-8"),
+             ('<html><head><meta charset="iso-8859-1"></head><body>' + block +
+              "</body></html>").encode("iso-8859-1"),
+             '<?xml version="1.0" encoding="utf-8"?><html><body>' + block + "</body></html>"]
+    for html in pages:
+        for parser in parsing.PARSERS:
+            assert parsing.parse_page(html, parser).course_blocks() == [
+                parsing.CourseBlock("ANTH 1. Naïve Café.", "Résumé", [])], parser
+
+def test_crawler_metrics(local_catalog, tmp_path):
+    ''' 
+        TEST: Checking that the metrics callback runs once per page and the report is written.
+    ''' 
+    options, _ = local_catalog
+    pages = []
+    report_filename = str(tmp_path / "report.json")
+    crawler.go(10, "course_map.json", str(tmp_path / "index.csv"),
+               metrics_callback=lambda url, metrics: pages.append(url),
+               report_filename=report_filename, **options)
+    with open(report_filename) as f:
+        report = json.load(f)
+    assert len(pages) == len(set(pages)) == 10
+    assert report["counters"]["pages"] == len(pages)
+
+def test_crawler_csv_resume(catalog_server, tmp_path):
+    ''' 
+        TEST: Checking that a crawl resumed from a checkpoint writes the same CSV.
+    ''' 
+    full = str(tmp_path / "full.csv")
+    resumed = str(tmp_path / "resumed.csv")
+    checkpoint_filename = str(tmp_path / "checkpoint.jsonl")
+    crawler.go(50, "course_map.json", full, **catalog_server)
+    with pytest.raises(Interrupted):
+        crawler.go(50, "course_map.json", resumed, checkpoint_filename=checkpoint_filename,
+                   checkpoint_every=10, metrics_callback=interrupt_at(25), **catalog_server)
+    metrics = crawler.go(50, "course_map.json", resumed,
+                         checkpoint_filename=checkpoint_filename, resume=True,
+                         **catalog_server)
+    assert metrics.counters["pages_resumed"] == 25
+    assert metrics.counters["pages"] == 25
+    assert not os.path.exists(checkpoint_filename)
+    with open(full, "rb") as f1, open(resumed, "rb") as f2:
+        assert f1.read() == f2.read()
+
+@pytest.mark.parametrize("catalog_server", [{"num_pages": 30}], indirect=True)
+def test_crawler_interrupted_cleanup(catalog_server, tmp_path):
+    ''' 
+        TEST: Checking that a crawl that raises shuts its index workers down.
+    ''' 
+    # The traceback keeps go()'s locals alive, as a caller handling the
+    # error would
+    with pytest.raises(Interrupted) as excinfo:
+        crawler.go(30, "course_map.json", str(tmp_path / "index.csv"), index_workers=2,
+                   metrics_callback=interrupt_at(5), **catalog_server)
+    assert multiprocessing.active_children() == []
+    assert excinfo.value
+
+@pytest.mark.parametrize("catalog_server", [{"num_pages": 30}], indirect=True)
+def test_crawler_interrupted_spilling(catalog_server, tmp_path, monkeypatch):
+    ''' 
+        TEST: Checking that a crawl that raises deletes the runs its spilling index wrote.
+    ''' 
+    run_root = tmp_path / "runs"
+    run_root.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(run_root))
+    with pytest.raises(Interrupted):
+        crawler.go(30, "course_map.json", str(tmp_path / "index.csv"), max_postings=5,
+                   metrics_callback=interrupt_at(10), **catalog_server)
+    assert list(run_root.iterdir()) == []
+
+def test_crawler_csv_adaptive(tmp_path):
+    ''' 
+        TEST: Checking that an adaptive crawl of a failing server retries and writes the same CSV.
+    ''' 
+    filenames = [str(tmp_path / "ok.csv"), str(tmp_path / "errors.csv")]
+    with serve_catalog(seed=1) as ok, serve_catalog(seed=1, error_rate=0.2) as failing:
+        crawler.go(100, "course_map.json", filenames[0], **ok)
+        metrics = crawler.go(100, "course_map.json", filenames[1], num_workers=4,
+                             adaptive=True, max_retries=10, **failing)
+    assert metrics.counters["fetch_retries"] > 0
+    assert metrics.failures == {}
+    with open(filenames[0], "rb") as f1, open(filenames[1], "rb") as f2:
+        assert f1.read() == f2.read()
+
+def test_scheduler_aimd():
+    ''' 
+        TEST: Checking that the host limit grows on success, halves on errors and failures are recorded.
+    ''' 
+    def ok(url):
+        return "request", "html"
+
+    def overloaded(url):
+        raise fetch.TransientError(url, "HTTP 503")
+
+    s = scheduler.AdaptiveScheduler(8, max_retries=2, sleep=lambda seconds: None)
+    for _ in range(100):
+        assert s.scheduled(ok)("http://a.edu/") == ("request", "html")
+    assert s.limits()["a.edu"] == 8
+    s.host_limit("http://a.edu/").latency = 0.0
+    assert s.scheduled(overloaded)("http://a.edu/x.html") == (None, None)
+    assert s.limits()["a.edu"] == 1
+    assert s.failed == {"http://a.edu/x.html": "HTTP 503"}
+
+@pytest.mark.parametrize("catalog_server", [{"num_pages": 30}], indirect=True)
+def test_crawler_positions(catalog_server, tmp_path):
+    ''' 
+        TEST: Checking that positions and BM25 statistics are loaded for every posting.
+    ''' 
+    tables = []
+    for index_workers in [1, 2]:
+        db_filename = str(tmp_path / "courses-{}.sqlite3".format(index_workers))
+        crawler.go(30, "course_map.json", str(tmp_path / "index.csv"),
+                   db_filename=db_filename, positions=True, index_workers=index_workers,
+                   **catalog_server)
+        conn = sqlite3.connect(db_filename)
+        tables.append((conn.execute("SELECT course_id, word FROM catalog_index").fetchall(),
+                       conn.execute("SELECT * FROM catalog_positions").fetchall()))
+        stats = conn.execute("SELECT s.word, MAX(s.score), t.max_score, COUNT(*), t.df "
+                             "FROM catalog_scores AS s JOIN catalog_term_stats AS t "
+                             "ON s.word = t.word GROUP BY s.word").fetchall()
+        conn.close()
+        assert stats and all(row[1] == row[2] and row[3] == row[4] for row in stats)
+    postings, positions = tables[0]
+    assert tables[1] == tables[0]
+    assert set(postings) == set((course_id, word) for course_id, word, _ in positions)
+    for _, _, data in positions:
+        decoded = positional.decode_positions(data)
+        assert decoded == sorted(set(decoded))
+
+def test_analyzer_positions():
+    ''' 
+        TEST: Checking that positions skip stop words and courses gap their texts.
+    ''' 
+    a = analyzer.Analyzer(crawler.INDEX_IGNORE)
+    assert a.positions("History of the Modern Art") == ({"history": [0], "modern": [3], "art": [4]}, 5)
+    index = positional.PositionalIndex()
+    index.merge([[7, *positional.course_document([a.positions("Art Art"), a.positions("art")])]])
+    index.merge([[7, {"art": [0]}, 1]])
+    gap = positional.POSITION_GAP
+    assert index.positions(7, "art") == [0, 1, 2 + gap, 3 + 2 * gap]
+
+def test_analyzer_shared_terms():
+    ''' 
+        TEST: Checking that terms tokenized separately combine into the words of the joined text.
+    ''' 
+    parts = ["CMSC 12100-12200. Computer Science with Applications I-II.",
+             "Students learn computer-science basics; the sequence covers data.",
+             "Data_structures, naïve algorithms & Python 3-4."]
+    a = analyzer.Analyzer(crawler.INDEX_IGNORE)
+    expected = crawler.extract_words(" ".join(parts))
+    assert a.unique(*[a.terms(part) for part in parts]) == expected
+    assert "the" not in expected and "computer-science" in expected
+
+def test_analyzer_stop_words():
+    ''' 
+        TEST: Checking that extra stop words are left out.
+    ''' 
+    a = analyzer.Analyzer(crawler.INDEX_IGNORE | {"data"})
+    assert a.extract_words("Data and data science") == ["science"]
+
+def test_binindex_roundtrip(tmp_path):
+    ''' 
+        TEST: Checking that the binary index reads back the postings written.
+    ''' 
+    index = {"language": {91, 7, 2616}, "anth": {0}, "café": {300, 1, 100000},
+             "zebra": set()}
+    filename = str(tmp_path / "index.bin")
+    binindex.write_index(index, filename)
+    with binindex.IndexReader(filename) as reader:
+        assert len(reader) == 4
+        assert list(reader.terms()) == sorted(index)
+        for word, course_ids in index.items():
+            assert reader.postings(word) == sorted(course_ids)
+        assert reader.postings("missing") == []
+        assert "anth" in reader and "ant" not in reader
+
+def test_spilling_index_csv(tmp_path):
+    ''' 
+        TEST: Checking that the spilling index writes the same CSV as write_to_csv.
+    ''' 
+    pages = [{"history": {3, 1}, "language": {2}},
+             {"language": {1, 2}, "anth": {0}},
+             {"history": {0, 3}, "essay": {106}}]
+    index = {}
+    spilling = extsort.SpillingIndex(2, tmp_dir=str(tmp_path))
+    for page_index in pages:
+        crawler.merge_index(index, page_index)
+        spilling.merge(page_index)
+    assert len(spilling.runs) > 1
+    crawler.write_to_csv(index, str(tmp_path / "dict.csv"))
+    spilling.write_csv(str(tmp_path / "spilled.csv"))
+    spilling.close()
+    with open(str(tmp_path / "dict.csv")) as f1, open(str(tmp_path / "spilled.csv")) as f2:
+        assert f1.read() == f2.read()
+
+def test_dbload_replaces_table(tmp_path):
+    ''' 
+        TEST: Checking that the bulk load replaces catalog_index and keeps its indexes.
+    ''' 
+    db_filename = str(tmp_path / "courses.sqlite3")
+    conn = sqlite3.connect(db_filename)
+    conn.execute(dbload.DEFAULT_SCHEMA)
+    conn.execute("CREATE INDEX idx_word ON catalog_index (word, course_id)")
+    conn.execute("INSERT INTO catalog_index VALUES (1, 'stale')")
+    conn.commit()
+    conn.close()
+
+    index = {"history": {3, 1}, "language": {2}}
+    assert dbload.load_index(dbload.index_rows(index), db_filename, batch_size=2) == 3
+
+    conn = sqlite3.connect(db_filename)
+    rows = conn.execute("SELECT course_id, word FROM catalog_index").fetchall()
+    indexes = conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                           "AND tbl_name = 'catalog_index'").fetchall()
+    conn.close()
+    assert sorted(rows) == [(1, "history"), (2, "language"), (3, "history")]
+    assert indexes == [("idx_word",)]
+
+def test_dbload_catalog_single_transaction(tmp_path):
+    ''' 
+        TEST: Checking that a failed load of the positions leaves catalog_index unchanged.
+    ''' 
+    class Failing(positional.PositionalIndex):
+        def rows(self):
+            yield 1, "history", b""
+            raise RuntimeError("load failed")
+
+    db_filename = str(tmp_path / "courses.sqlite3")
+    dbload.load_index([(1, "stale")], db_filename)
+    index = Failing()
+    index.merge([[1, {"history": [0]}, 1]])
+    with pytest.raises(RuntimeError):
+        dbload.load_catalog([(1, "history")], db_filename, index, {"the"})
+    conn = sqlite3.connect(db_filename)
+    rows = conn.execute("SELECT course_id, word FROM catalog_index").fetchall()
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+    conn.close()
+    assert rows == [(1, "stale")]
+    assert tables == [("catalog_index",)]
+
+def test_frontier_dedup():
+    ''' 
+        TEST: Checking that the frontier queues a URL once and never after it is visited.
+    ''' 
+    f = frontier.Frontier(["http://a.edu/"], "a.edu")
+    assert not f.push("http://a.edu/")
+    assert f.push("http://a.edu/x.html")
+    assert f.pop() == "http://a.edu/"
+    # popped but not visited (failed request): may be queued again
+    assert f.push("http://a.edu/")
+    assert list(f) == ["http://a.edu/x.html", "http://a.edu/"]
+    assert f.pop() == "http://a.edu/x.html"
+    assert f.pop() == "http://a.edu/"
+    f.mark_visited("http://a.edu/")
+    assert not f.push("http://a.edu/")
+    assert len(f) == 0
+
+def test_frontier_bloom():
+    ''' 
+        TEST: Checking that the Bloom filter has no false negatives.
+    ''' 
+    urls = ["http://a.edu/{}.html".format(i) for i in range(10000)]
+    bloom = frontier.BloomFilter(len(urls), 1e-3)
+    for url in urls:
+        bloom.add(url)
+    assert all(url in bloom for url in urls)
+    false_positives = sum("http://b.edu/{}.html".format(i) in bloom for i in range(10000))
+    assert false_positives < 100
+
 @pytest.fixture(scope="module")
 def gen_dict():
-    crawler.go(num_pages_to_crawl, "course_map.json", "catalog-index-actual.csv")
+    crawler.go(num_pages_to_crawl, "course_map.json", "catalog-index-actual.csv",
+               **GO_OPTIONS)
     return load_csv("catalog-index-actual.csv", ci_to_cn, 3)
 
 @pytest.mark.parametrize("ci, word, reason, expected", TEST_DATA)